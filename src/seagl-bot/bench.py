@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+
+"""Offline benchmarks for the SeaGL bot's hot paths.
+
+Runs against a throw-away SQLite database in a temp directory, so it is
+safe to run on any Linux box without an IRC network or a config.py.
+
+Usage:
+    python3 bench.py [enqueue] [joins] [metrics] [shuffle] [sqlite] [protocol] [-n 5000]
+                     [--rate 500]
+"""
+
+import os
+import sys
+import time
+import types
+import random
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_config(workdir):
+    """ Register a 'config' module built from sample_config, pointed at workdir.
+
+        Keyword arguments:
+        workdir -- string: directory for the temp DB and output files
+    """
+
+    import sample_config
+
+    cfg = types.ModuleType("config")
+    for k, v in vars(sample_config).items():
+        if not k.startswith("__"):
+            setattr(cfg, k, v)
+
+    cfg.nickname = "seagl-bench"
+    cfg.initial_channels = ["seagl-hallway"]
+    cfg.channels_admin = ["seagl-staff"]
+    cfg.botops = ["bench-op"]
+    cfg.sqlite_path = os.path.join(workdir, "db", "seagl-bot.db")
+    cfg.metric_path = os.path.join(workdir, "channel_counts.json")
+    cfg.bot_log_dir = os.path.join(workdir, "logs")
+    sys.modules["config"] = cfg
+    return cfg
+
+
+def report(name, count, elapsed):
+    rate = count / elapsed if elapsed > 0 else float("inf")
+    print("{:<28} {:>8} ops {:>9.3f}s {:>12.1f} ops/s".format(name, count, elapsed, rate))
+
+
+def percentile(samples, p):
+    """ Return the p-th percentile (0-100) of an already sorted list """
+
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100.0))]
+
+
+def report_latency(name, samples):
+    samples.sort()
+    busy = sum(samples)
+    rate = len(samples) / busy if busy > 0 else float("inf")
+    print("{:<28} {:>8} ops {:>12.1f} ops/s  p50 {:>8.1f}us  p99 {:>8.1f}us".format(
+        name, len(samples), rate, percentile(samples, 50) * 1e6, percentile(samples, 99) * 1e6))
+
+
+def bench_joins(cfg, n):
+    """ Time the userJoined DB path: store_user_login() + welcome enqueue.
+
+        'fresh' opens a new Database per join (the old behaviour),
+        'shared' reuses one process-wide handle.
+    """
+
+    import database
+
+    welcome = "Welcome!"
+    fresh_path = cfg.sqlite_path + ".fresh"
+
+    start = time.perf_counter()
+    for i in range(n):
+        db = database.Database(fresh_path)
+        if db.store_user_login("fresh-%d" % i):
+            db.enqueue_msg("fresh-%d" % i, welcome)
+        db.close()
+    report("joins (fresh handle)", n, time.perf_counter() - start)
+
+    db = database.get_database(cfg.sqlite_path)
+    start = time.perf_counter()
+    for i in range(n):
+        if db.store_user_login("shared-%d" % i):
+            db.enqueue_msg("shared-%d" % i, welcome)
+    report("joins (shared handle)", n, time.perf_counter() - start)
+
+
+def bench_enqueue(cfg, n):
+    """ Time enqueue_msg() on an empty queue and again with n rows pending,
+        plus the duplicate path.
+    """
+
+    import database
+
+    db = database.get_database(cfg.sqlite_path)
+    batch = max(1, n // 10)
+    for label, offset in (("empty", 0), ("full", n)):
+        if offset:
+            for i in range(batch, n):
+                db.enqueue_msg("#pad-%d" % i, "pad")
+        start = time.perf_counter()
+        for i in range(batch):
+            db.enqueue_msg("#%s-%d" % (label, i), "Announcement")
+        report("enqueue (%s queue)" % label, batch, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for i in range(batch):
+        db.enqueue_msg("#full-%d" % i, "Announcement")
+    report("enqueue (duplicates)", batch, time.perf_counter() - start)
+
+    # One !CA fan-out to 120 channels: a loop of enqueue_msg vs enqueue_msgs
+    dests = ["#seagl-room%d" % c for c in range(120)]
+    rounds = max(1, n // 100)
+    start = time.perf_counter()
+    for r in range(rounds):
+        for dest in dests:
+            db.enqueue_msg(dest, "Loop announcement %d" % r)
+    report("fan-out x120 (enqueue_msg)", rounds, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for r in range(rounds):
+        db.enqueue_msgs(dests, "Bulk announcement %d" % r)
+    report("fan-out x120 (enqueue_msgs)", rounds, time.perf_counter() - start)
+
+
+def bench_metrics(cfg, n):
+    """ Time get_channel_count_metric() with 120 channels of 50 nicks each """
+
+    import database
+
+    db = database.get_database(cfg.sqlite_path)
+    for c in range(120):
+        channel = "#seagl-room%d" % c
+        db.add_room("bench", "room%d" % c, channel)
+        db.add_channel_count(channel, ["nick%d" % i for i in range(c, c + 50)])
+
+    start = time.perf_counter()
+    for i in range(n):
+        db.get_channel_count_metric()
+    report("get_channel_count_metric", n, time.perf_counter() - start)
+
+
+def bench_shuffle(cfg, n):
+    """ Time !shuffle of a large topic into groups of 5, persistence included.
+        Uses max(n, 100000) members.
+    """
+
+    import database
+
+    members = max(n, 100000)
+    db = database.get_database(cfg.sqlite_path)
+    with db.connection:
+        db.connection.execute("INSERT INTO topics (name) VALUES ('bench')")
+        db.connection.executemany("INSERT INTO topic_members (topic, nick) VALUES ('bench', ?)",
+                                  (("nick%d" % i,) for i in range(members)))
+    db.load_topics()
+
+    start = time.perf_counter()
+    topic, groups = db.shuffle_users("bench 5")
+    report("shuffle (%d members)" % members, members, time.perf_counter() - start)
+
+
+def bench_sqlite(cfg, n):
+    """ Compare the tuned connection profile with SQLite's defaults on the
+        enqueue/dequeue and channel count write paths.
+    """
+
+    import database
+
+    profiles = (("default", database.SQLITE_DEFAULT_PROFILE),
+                ("tuned", database.sqlite_profile()))
+    for label, profile in profiles:
+        db = database.Database(cfg.sqlite_path + "." + label, profile)
+        db.add_rooms("bench", [("room%d" % c, "#seagl-room%d" % c) for c in range(50)])
+
+        start = time.perf_counter()
+        for i in range(n):
+            db.enqueue_msg("#seagl-room%d" % (i % 50), "Announcement %d" % i)
+        report("enqueue (%s)" % label, n, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        sent = 0
+        while True:
+            rows = db.peek_msgs(4)
+            if not rows:
+                break
+            db.delete_msgs([r[0] for r in rows])
+            sent += len(rows)
+        report("peek+delete x4 (%s)" % label, sent, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for i in range(n):
+            db.add_channel_count("#seagl-room%d" % (i % 50),
+                                 ["nick%d" % j for j in range(i % 7, i % 7 + 30)])
+        report("add_channel_count (%s)" % label, n, time.perf_counter() - start)
+
+        db.checkpoint("truncate")
+        db.close()
+
+
+PROTOCOL_MIX = (
+    ("chat", 40),
+    ("command", 25),
+    ("userJoined", 15),
+    ("userLeft", 7),
+    ("userQuit", 2),
+    ("userRenamed", 1),
+    ("irc_RPL_NAMREPLY", 10),
+)
+
+PROTOCOL_COMMANDS = ("!lt", "!lr", "!lr 3", "!ts proto", "!assignment proto",
+                     "!jt proto", "!ask why?", "!tea friend", "!cr room", "!ping")
+
+
+def protocol_events(n, channels, seed=2020):
+    """ Return n synthetic (handler, args) events following PROTOCOL_MIX """
+
+    rnd = random.Random(seed)
+    kinds = [k for k, weight in PROTOCOL_MIX for _ in range(weight)]
+    events = []
+    for i in range(n):
+        kind = rnd.choice(kinds)
+        nick = "user%d" % rnd.randrange(n // 4 + 1)
+        user = "%s!~%s@host%d.example" % (nick, nick, rnd.randrange(64))
+        channel = rnd.choice(channels)
+        if kind == "chat":
+            events.append(("privmsg", (user, channel, "hello from %s" % nick)))
+        elif kind == "command":
+            cmd = rnd.choice(PROTOCOL_COMMANDS)
+            if cmd == "!cr room":
+                cmd = "!cr room%d" % i
+            events.append(("privmsg", (user, channel, cmd)))
+        elif kind == "irc_RPL_NAMREPLY":
+            nicks = " ".join("user%d" % rnd.randrange(n // 4 + 1) for _ in range(50))
+            events.append((kind, ("irc.example", ["seagl-bench", "@", channel, nicks])))
+            events.append(("irc_RPL_ENDOFNAMES", ("irc.example", ["seagl-bench", channel, "End"])))
+        elif kind == "userQuit":
+            events.append((kind, (nick, "bye")))
+        elif kind == "userRenamed":
+            events.append((kind, (nick, nick + "_")))
+        else:
+            events.append((kind, (user, channel)))
+    return events
+
+
+def bench_protocol(cfg, n, rate=0, db_timing=False):
+    """ Drive bot.IRCProtocol on a fake transport with synthetic privmsg,
+        userJoined, userLeft, userQuit, userRenamed and NAMES traffic.
+
+        Reports, per handler, the time spent on the reactor thread
+        (throughput and p50/p99) and, per command, the end-to-end latency
+        from the command registry, database round trips included.
+
+        Keyword arguments:
+        n -- int: number of events
+        rate -- float: offered events per second, 0 sends as fast as possible
+        db_timing -- bool: also report per Database method timings
+    """
+
+    from twisted.internet import reactor, task
+    from twisted.internet.testing import StringTransport
+
+    # Measure the handlers, not the flood limits
+    cfg.flood_nick_rate = cfg.flood_host_rate = cfg.flood_channel_rate = "0"
+    cfg.db_timing = str(db_timing)
+    os.makedirs(cfg.bot_log_dir, exist_ok=True)
+
+    import bot
+    import database
+
+    if db_timing:
+        database.close_all()
+    factory = bot.IRCFactory("")
+    db = factory.db
+    db.add_rooms("bench", [("room-%d" % c, "#seagl-bench%d" % c) for c in range(50)])
+    db.join_topic("bench-op", "proto")
+    channels = db.room_list()
+
+    proto = factory.shards[0].buildProtocol(None)
+    proto.lineRate = None
+    transport = StringTransport()
+    proto.makeConnection(transport)
+    for channel in channels:
+        proto.joined(channel)
+
+    events = protocol_events(n, channels)
+    samples = dict()
+    registry = proto.command_registry
+    clock = time.perf_counter
+    tick = 0.01
+    per_tick = max(1, int(rate * tick)) if rate > 0 else 200
+    position = [0]
+
+    def label(handler, args):
+        if handler != "privmsg":
+            return handler
+        message = args[2]
+        if message.startswith("!"):
+            return "privmsg " + message.split(" ")[0]
+        return "privmsg (chat)"
+
+    def send():
+        batch = events[position[0]:position[0] + per_tick]
+        position[0] += len(batch)
+        for handler, args in batch:
+            func = getattr(proto, handler)
+            start = clock()
+            func(*args)
+            samples.setdefault(label(handler, args), []).append(clock() - start)
+        transport.clear()
+        if position[0] >= len(events):
+            loop.stop()
+
+    def drained():
+        proto.flush_members()
+        pending = sum(c.calls - c.histogram.count for c in registry.commands.values())
+        if pending and clock() - wall < 60:
+            reactor.callLater(tick, drained)
+            return
+        elapsed[0] = clock() - wall
+        reactor.stop()
+
+    loop = task.LoopingCall(send)
+    elapsed = [0.0]
+    wall = clock()
+    d = loop.start(tick if rate > 0 else 0)
+    d.addCallback(lambda _: drained())
+    reactor.run()
+
+    proto.cl.close()
+    print("protocol: %d events in %.3fs (%.1f events/s, offered %s)" % (
+        n, elapsed[0], n / elapsed[0], ("%g/s" % rate) if rate > 0 else "unthrottled"))
+    for name in sorted(samples):
+        report_latency(name, samples[name])
+    for name, stats in sorted(registry.stats().items()):
+        print("  command {:<19} {:>8} calls  p50 {:>8.1f}ms  p99 {:>8.1f}ms  max {:>8.1f}ms".format(
+            name, stats["calls"], stats["p50_ms"], stats["p99_ms"], stats["max_ms"]))
+    if db_timing:
+        print(db.timing_summary(limit=20))
+
+
+BENCHMARKS = {
+    "enqueue": bench_enqueue,
+    "metrics": bench_metrics,
+    "shuffle": bench_shuffle,
+    "sqlite": bench_sqlite,
+    "joins": bench_joins,
+    "protocol": bench_protocol,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("names", nargs="*", default=sorted(BENCHMARKS),
+                        help="benchmarks to run: " + ", ".join(sorted(BENCHMARKS)))
+    parser.add_argument("-n", type=int, default=2000, help="operations per benchmark")
+    parser.add_argument("--rate", type=float, default=0,
+                        help="protocol: offered events per second, 0 is unthrottled")
+    parser.add_argument("--db-timing", action="store_true",
+                        help="protocol: instrument Database methods and report them")
+    args = parser.parse_args()
+
+    for name in args.names:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark: " + name)
+
+    workdir = tempfile.mkdtemp(prefix="seagl-bench-")
+    try:
+        cfg = load_config(workdir)
+        import database
+        for name in args.names:
+            if name == "protocol":
+                # Runs the reactor, which cannot be restarted: keep it last
+                continue
+            BENCHMARKS[name](cfg, args.n)
+        if "protocol" in args.names:
+            bench_protocol(cfg, args.n, args.rate, args.db_timing)
+        database.close_all()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
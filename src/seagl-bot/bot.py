@@ -6,15 +6,21 @@ import os
 import re
 import sys
 import time
-import json
 import config
 import getpass
 import logging
 import getpass
 import random
 import channel_logger
-
-from twisted.internet import defer, endpoints, protocol, reactor, ssl, task
+import commands
+import dispatcher
+import flood
+import membership
+import metrics
+import names_poller
+import sharding
+
+from twisted.internet import defer, endpoints, protocol, reactor, ssl, task, threads
 from twisted.python import log
 from twisted.words.protocols import irc
 
@@ -43,40 +49,91 @@ HELP = """\n
 !ask: - Ask Conference Speaker a question
 """
 
+def get_log_path():
+    """ Return the bot's log directory, creating it if missing.
+        Defaults to /home/<user>/seagl-bot.d unless config.bot_log_dir is set.
+    """
+
+    bot_log_path = getattr(config, "bot_log_dir", "")
+    if not bot_log_path:
+        bot_log_path = os.path.join('/home', str(getpass.getuser()), 'seagl-bot.d')
+    if not os.path.exists(bot_log_path):
+        os.mkdir(bot_log_path, 0o755)
+    return bot_log_path
+
+
+@commands.registry
 class IRCProtocol(irc.IRCClient):
     nickname = config.nickname
 
 
     def __init__(self):
-        self.lineRate = 1
+        # No Twisted line queue: queued messages are paced by the
+        # Dispatcher's token bucket, and written as soon as they are sent
+        self.lineRate = None
+        self.lines_out = 0
         self.password = ''
         self.deferred = defer.Deferred()
 
-        # Keep track of the last room ID that got a channel count taken
-        self.last_chan_id = 1
+        self.names_poller = None
+        self.membership = membership.Membership()
 
-        bot_log_path = os.path.join('/home', str(getpass.getuser()), 'seagl-bot.d')
-        channel_logs = os.path.join(bot_log_path, 'channels-logs')
+        channel_logs = os.path.join(get_log_path(), 'channels-logs')
         if not os.path.exists(channel_logs):
             os.mkdir(channel_logs, 0o755)
-        self.cl = channel_logger.channel_logger(channel_logs)
+        self.cl = channel_logger.channel_logger(
+            channel_logs,
+            max_open=int(getattr(config, "log_max_open", 32)),
+            flush_bytes=int(getattr(config, "log_flush_bytes", 65536)),
+            flusher=reactor.callInThread)
+        reactor.addSystemEventTrigger("before", "shutdown", self.cl.close)
 
 
     def connectionLost(self, reason):
         logging.info("Connection Lost: "+str(reason))
+        if self.factory.client is self:
+            self.factory.client = None
+        self.cl.close()
+        if self.names_poller:
+            self.names_poller.stop()
         self.deferred.errback(reason)
 
 
     def signedOn(self):
-        for channel in self.factory.channels:
-            logging.info("Signon: " + channel)
+        shard = self.factory.shard
+        pool = self.factory.pool
+        self.factory.client = self
+        for channel in pool.shard_channels(shard):
+            logging.info("Signon: " + channel + " shard " + str(shard))
             self.join(channel)
 
-        c = task.LoopingCall(self.query_names)
-        c.start(int(config.names_query_interval))
-
-        b = task.LoopingCall(self.broadcaster)
-        b.start(int(config.broadcaster_interval))
+        # Membership is tracked from events; NAMES only reconciles drift
+        self.names_poller = names_poller.NamesPoller(
+            self, lambda: pool.shard_rooms(shard),
+            freshness=float(getattr(config, "names_freshness", 1800)),
+            batch=int(getattr(config, "names_batch", 4)),
+            min_interval=float(getattr(config, "names_min_interval", 1)),
+            max_interval=float(config.names_query_interval))
+        self.names_poller.start()
+
+        self.dispatcher = dispatcher.Dispatcher(
+            self, self.factory.adb,
+            rate=float(getattr(config, "dispatch_rate", 1)),
+            burst=int(getattr(config, "dispatch_burst", 4)),
+            max_targets=int(getattr(config, "dispatch_max_targets", 4)),
+            shard=shard)
+        b = task.LoopingCall(self.dispatcher.tick)
+        b.start(float(getattr(config, "dispatch_tick", 0.5)))
+
+        f = task.LoopingCall(reactor.callInThread, self.cl.flush)
+        f.start(float(getattr(config, "log_flush_interval", 5)))
+
+        c = task.LoopingCall(self.flush_members)
+        c.start(float(getattr(config, "membership_flush_interval", 2)), now=False)
+
+        # Database-wide jobs run once, on the home shard
+        if shard != 0:
+            return
 
         m = task.LoopingCall(self.publish_metrics)
         m.start(int(config.metrics_interval))
@@ -87,18 +144,84 @@ class IRCProtocol(irc.IRCClient):
         j = task.LoopingCall(self.chan_user_audit)
         j.start(int(config.channel_user_audit))
 
+        a = task.LoopingCall(self.flush_attendees)
+        a.start(float(getattr(config, "attendee_flush_interval", 5)))
+
+        r = task.LoopingCall(self.prune_channel_counts)
+        r.start(int(getattr(config, "channel_counts_prune_interval", 3600)), now=False)
+
+        w = task.LoopingCall(self.checkpoint)
+        w.start(int(getattr(config, "sqlite_checkpoint_interval", 300)), now=False)
+
+
+    def joined(self, channel):
+        # The server follows our JOIN with NAMES, which fills the set
+        self.membership.reset(channel)
+
+
+    def left(self, channel):
+        self.membership.drop(channel)
+
+
+    def kickedFrom(self, channel, kicker, message):
+        self.membership.drop(channel)
+
 
     def userJoined(self, user, channel):
         nick, _, host = user.partition("!")
+        self.membership.joined(channel, nick)
         self.cl.log_chan(nick, channel, "joined-channel")
-        db = database.Database(config.sqlite_path)
-        if db.store_user_login(nick):
-            db.enqueue_msg(nick, WELCOME_MSG)
+        # In-memory check; new nicks are persisted by flush_attendees()
+        if self.factory.db.store_user_login(nick):
+            d = self.factory.adb.enqueue_msg(nick, WELCOME_MSG)
+            d.addErrback(self._logError, "userJoined")
+
+    def flush_attendees(self):
+        d = self.factory.adb.flush_attendees()
+        d.addErrback(self._logError, "flush_attendees")
+        return d
+
+    def prune_channel_counts(self):
+        d = self.factory.adb.prune_channel_counts()
+        d.addErrback(self._logError, "prune_channel_counts")
+        return d
+
+    def checkpoint(self):
+        d = self.factory.adb.checkpoint()
+        d.addErrback(self._logError, "checkpoint")
+        return d
+
+    def flush_members(self):
+        """ Persist the membership of channels changed since the last flush
+        """
+
+        db = self.factory.db
+        snapshots = dict((c, nicks) for c, nicks in self.membership.take_dirty().items()
+                         if db.channel_exists(c))
+        if not snapshots:
+            return
+        d = self.factory.adb.add_channel_counts(snapshots)
+        d.addErrback(self._logError, "flush_members")
+        return d
 
     def userLeft(self, user, channel):
         nick, _, host = user.partition("!")
+        self.membership.left(channel, nick)
         self.cl.log_chan(nick, channel, "Left-channel")
 
+    def userQuit(self, user, quitMessage):
+        nick, _, host = user.partition("!")
+        for channel in self.membership.quit(nick):
+            self.cl.log_chan(nick, channel, "Quit")
+
+    def userKicked(self, kickee, channel, kicker, message):
+        self.membership.left(channel, kickee)
+        self.cl.log_chan(kickee, channel, "Kicked-by-" + kicker)
+
+    def userRenamed(self, oldname, newname):
+        for channel in self.membership.renamed(oldname, newname):
+            self.cl.log_chan(oldname, channel, "Renamed-to-" + newname)
+
     def privmsg(self, user, channel, message):
         nick, _, host = user.partition("!")
         message = message.strip()
@@ -108,18 +231,41 @@ class IRCProtocol(irc.IRCClient):
             return
         command, sep, rest = message.lstrip("!").partition(" ")
 
-        func = getattr(self, "command_" + command, None)
-        if not func:
+        cmd = self.command_registry.lookup(command)
+        if cmd is None:
+            return
+        if not self.flood_ok(cmd, nick, host, channel):
+            cmd.limited += 1
             return
-        deferred = defer.maybeDeferred(func, nick, channel, rest)
+        deferred = self.command_registry.dispatch(self, cmd, nick, channel, rest)
         deferred.addErrback(self._showError)
         #if channel == self.nickname:
-        deferred.addCallback(self._sendMessage, nick)
+        deferred.addCallback(self._sendReply, nick)
         #else:
-        #deferred.addCallback(self._sendMessage, channel, nick)
+        #deferred.addCallback(self._sendReply, channel, nick)
+
+
+    def flood_ok(self, cmd, nick, host, channel):
+        """ Check the command against the nick, hostmask and channel
+            buckets. Bot operators are not limited.
+            Return: bool
+        """
 
+        if nick in config.botops:
+            return True
+        cost = float(self.factory.flood_costs.get(cmd.name, cmd.cost))
+        if channel == self.nickname:
+            channel = None
+        return self.factory.flood.allow(
+            cost, nick=nick, host=host.partition("@")[2] or None, channel=channel)
 
-    def _sendMessage(self, msg, target, nick=None):
+
+    def sendLine(self, line):
+        self.lines_out += 1
+        irc.IRCClient.sendLine(self, line)
+
+
+    def _sendReply(self, msg, target, nick=None):
         if nick:
             msg = "%s, %s" % (nick, msg)
         self.msg(target, msg, length=100)
@@ -129,6 +275,15 @@ class IRCProtocol(irc.IRCClient):
         return failure.getErrorMessage()
 
 
+    def _logError(self, failure, where):
+        logging.error("Error: " + where + "(): " + failure.getErrorMessage())
+
+
+    def _logReply(self, channel, rtn):
+        self.cl.log_chan("seagl-bot", channel, rtn)
+        return rtn
+
+
     def command_ping(self, nick, channel, rest):
         self.cl.log_chan("seagl-bot", channel, "pong")
         return "pong"
@@ -140,33 +295,13 @@ class IRCProtocol(irc.IRCClient):
         return HELP
 
 
-    def broadcaster(self):
-        """ Send messages listed in the msg_queue table.
-            This function is run as a thread off of the main
-            reactor loop. Throttling the messaging keeps the bot
-            from being kicked on network for flooding.
-        """
-
-        db = database.Database(config.sqlite_path)
-        tpl = db.dequeue_msg()
-        if tpl != ():
-            ID   = tpl[0]
-            dest = tpl[1]
-            msg  = tpl[2]
-            self.msg(str(dest), str(msg))
-
-            size = db.msg_queue_size()
-            logging.info("mst queue size:"+size) 
-            logging.info("Broadcast to: " + str(ID) + ":" + dest + ":" + msg)
-        return
-
-
+    @commands.command("sched")
     def command_schedule(self, nick, channel, rest):
         logging.info("CMD: command_schedule")
         return  "https://osem.seagl.org/conferences/seagl2020/schedule#2020-11-14"
-    command_sched = command_schedule
 
 
+    @commands.command("CA", botops=True)
     def command_conf_announce(self, nick, channel, rest):
         """ Send announcement message to all conference channels.
             Return: string
@@ -178,28 +313,28 @@ class IRCProtocol(irc.IRCClient):
         """
 
         logging.info("CMD: command_conf_announce")
-        if not nick in config.botops:
-            return "Operation not permitted user."
-
         """ Sanitize input """
         san_args = rest
         for c in ["'", "\"", ";", "*"]:
             san_args = san_args.replace(c, "")
         msg = re.sub(' +', ' ', san_args)
 
-        db = database.Database(config.sqlite_path)
-        conf_channels = db.get_room_list()
-        for i in range(len(conf_channels)):
-            if not conf_channels[i].startswith('#'):
-                conf_channels[i] = "#"+conf_channels[i]
+        adb = self.factory.adb
 
-        for dest in conf_channels:
-            db.enqueue_msg(dest, "Announcement: "+msg)
-        return "Announcement Queued."
+        def queue(conf_channels):
+            for i in range(len(conf_channels)):
+                if not conf_channels[i].startswith('#'):
+                    conf_channels[i] = "#"+conf_channels[i]
+            return adb.enqueue_msgs(conf_channels, "Announcement: "+msg)
 
-    command_CA = command_conf_announce
+        d = adb.get_room_list()
+        d.addCallback(queue)
+        d.addCallback(self._queued)
+        return d
 
 
+
+    @commands.command("AA", botops=True)
     def command_admin_announce(self, nick, channel, rest):
         """ Send announcement message to all Admin channels.
             Return: string
@@ -211,28 +346,23 @@ class IRCProtocol(irc.IRCClient):
         """
 
         logging.info("CMD: command_admin_announce")
-        if not nick in config.botops:
-            return "Operation not permitted user."
-
         """ Sanitize input """
         san_args = rest
         for c in ["'", "\"", ";", "*"]:
             san_args = san_args.replace(c, "")
         msg_to_admins = re.sub(' +', ' ', san_args)
 
-        admin_channels = config.channels_admin
-        for i in range(len(admin_channels)):
-            if not admin_channels[i].startswith('#'):
-                admin_channels[i] = "#"+admin_channels[i]
+        # Local copy: config.channels_admin is read elsewhere without '#'
+        admin_channels = ["#" + c.lstrip("#") for c in config.channels_admin]
 
-        db = database.Database(config.sqlite_path) 
-        for dest in admin_channels:
-            db.enqueue_msg(dest, "Announcement: "+msg_to_admins)
-        return "Announcement Queued."
+        adb = self.factory.adb
+        d = adb.enqueue_msgs(admin_channels, "Announcement: "+msg_to_admins)
+        d.addCallback(self._queued)
+        return d
 
-    command_AA = command_admin_announce
 
 
+    @commands.command("LA", botops=True)
     def command_list_announce(self, nick, channel, rest):
         """ Send announcement message to all users of a topic list. 
             Return: string
@@ -244,9 +374,6 @@ class IRCProtocol(irc.IRCClient):
         """
 
         logging.info("CMD: command_list_announce")
-        if not nick in config.botops:
-            return "Operation not permitted user."
-
         if rest == "":
             return "Error: Missing arguments, <topic-group> <message>"
 
@@ -258,21 +385,28 @@ class IRCProtocol(irc.IRCClient):
         args_lst = san_args.split(" ")
         topic = args_lst[0] 
 
-        if not self.factory.db.topic_exists(topic+'_list'):
-            return "Error: Topic does not exist."
         msg = " ".join(args_lst[1:])
+        return self._list_announce(nick, topic, msg)
+
 
-        """ Combine theese 2 commands """
-        subscribers = self.factory.db.topic_subs(nick, topic)
-        lst = subscribers.split(" ")
 
-        sub_lst = list(filter(lambda x: x != "", lst))
-        db = database.Database(config.sqlite_path)
-        for dest in sub_lst:
-            db.enqueue_msg(dest, "Announcement: "+msg)
-        return "Announcement Queued."
+    @defer.inlineCallbacks
+    def _list_announce(self, nick, topic, msg):
+        adb = self.factory.adb
+        if not self.factory.db.topic_exists(topic):
+            return "Error: Topic does not exist."
+
+        queued = yield adb.enqueue_topic(
+            topic, "Announcement: "+msg, int(getattr(config, "announce_chunk_size", 500)))
+        return self._queued(queued)
+
 
-    command_LA = command_list_announce
+    def _queued(self, queued):
+        """ Reply for an announcement, given enqueue_msgs() result """
+
+        if queued < 0:
+            return "Error: Announcement not queued."
+        return "Announcement Queued: %d message(s)." % queued
 
 
     def command_assignment(self, nick, channel, rest):
@@ -290,6 +424,7 @@ class IRCProtocol(irc.IRCClient):
         return self.factory.db.get_assignment(nick, topic)
 
 
+    @commands.command("jt", "joingame")
     def command_jointopic(self, nick, channel, rest):
         """ Add user nick to topic list.
             Return: string
@@ -308,14 +443,13 @@ class IRCProtocol(irc.IRCClient):
         if topic == "":
             return 'Error: No argument provided'
 
-        self.factory.db.join_topic(nick, topic)
         rtn = "Adding "+ nick + " to list: " + topic
-        self.cl.log_chan("seagl-bot", channel, rtn)
-        return rtn 
-    command_jt = command_jointopic
-    command_joingame = command_jointopic
+        d = self.factory.adb.join_topic(nick, topic)
+        d.addCallback(lambda _: self._logReply(channel, rtn))
+        return d
 
 
+    @commands.command("ts")
     def command_topicsubs(self, nick, channel, rest):
         """ Get list of user of a topic.
             Return: string
@@ -336,11 +470,10 @@ class IRCProtocol(irc.IRCClient):
         if topic == "":
             return 'Error: No argument provided'
         rtn = self.factory.db.topic_subs(nick, topic)
-        self.cl.log_chan("seagl-bot", channel, rtn)
-        return rtn
-    command_ts = command_topicsubs
+        return self._logReply(channel, rtn)
 
 
+    @commands.command("lt")
     def command_listtopics(self, nick, channel, rest):
         """ Get list of topics.
             Return: string
@@ -354,11 +487,10 @@ class IRCProtocol(irc.IRCClient):
         logging.info("CMD: command_listtopics")
 
         rtn = self.factory.db.list_topics()
-        self.cl.log_chan("seagl-bot", channel, rtn)
-        return rtn
-    command_lt = command_listtopics
+        return self._logReply(channel, rtn)
 
 
+    @commands.command("tea", cost=2)
     def command_teagl(self, nick, channel, rest):
 
         logging.info("CMD: command_teagl")
@@ -372,11 +504,11 @@ class IRCProtocol(irc.IRCClient):
             return 'Error: No argument provided'
 
         msg = "".join([user_id, ', ', nick, ' sent you a toast: ', RANDOM_TOAST[str(random.randint(0,5))]])
-        self._sendMessage(msg, channel, nick=None)
+        self._sendReply(msg, channel, nick=None)
         return "Tea Toast sent to %s." % user_id
-    command_tea = command_teagl
 
 
+    @commands.command("q", botops=True)
     def command_questions(self, nick, channel, rest):
         """ Read channel question list
             Return: string
@@ -389,11 +521,6 @@ class IRCProtocol(irc.IRCClient):
 
         logging.info("CMD: command_questions")
 
-        try:
-            config.botops.index(nick)
-        except Exception as e:
-            return "Not permitted"
-
         qnum = 1
         user_input = rest
         for c in [" ", "'", "\"", ";", "*",]:
@@ -406,10 +533,10 @@ class IRCProtocol(irc.IRCClient):
                 qnum = 1
         except Exception as e:
             logging.error("command_ask():" + str(e))
-        return self.factory.db.read_question(qnum, channel)
-    command_q = command_questions
+        return self.factory.adb.read_question(qnum, channel)
 
 
+    @commands.command(cost=2)
     def command_ask(self, nick, channel, rest):
         """ Ask a Question 
             Return: string
@@ -436,32 +563,32 @@ class IRCProtocol(irc.IRCClient):
 
         # CHECK CREATE_ROOM POLICY. 
 
-        self.factory.db.add_question(nick, user_input, channel)
-
         rtn = "Question Submitted."
-        self.cl.log_chan("seagl-bot", channel, rtn)
-        logging.info(rtn)
-        return rtn
-    command_ask = command_ask
+        d = self.factory.adb.add_question(nick, user_input, channel)
+        d.addCallback(lambda _: logging.info(rtn))
+        d.addCallback(lambda _: self._logReply(channel, rtn))
+        return d
     
 
+    @commands.command(botops=True)
     def command_clear_question_list(self, nick, channel, rest):
         """
         """
 
         logging.info("CMD: command_clear_question_list")
 
-        try:
-            config.botops.index(nick)
-        except Exception as e:
-            return "Not permitted"
+        def cleared(ok):
+            if not ok:
+                logging.error("Error: command_clear_question_list() Failed to delete table")
+                return "Failed to clear list"
+            return "Question list cleared"
 
-        if not self.factory.db.clear_question_list(channel):
-            logging.error("Error: command_clear_question_list() Failed to delete table")
-            return "Failed to clear list"
-        return "Question list cleared"
+        d = self.factory.adb.clear_question_list(channel)
+        d.addCallback(cleared)
+        return d
 
 
+    @commands.command("cr", cost=5)
     def command_createroom(self, nick, channel, rest):
         """ Create channel and jitsi room 
             Return: string
@@ -488,17 +615,28 @@ class IRCProtocol(irc.IRCClient):
         channel = "#seagl-" + room_id
         link    = config.JITSI_PREFIX + room_id
         #link    = "https://meet.seagl.org/seagl-" + room_id
-        self.factory.db.add_room(nick, link, channel)
-        self.join(channel)
-        self.topic(channel, link)
+        pool = self.factory.pool
+        shard = pool.least_loaded()
 
-        rtn = " ".join(["Created Channel:", channel, " Video-conf:", link])
-        self.cl.log_chan("seagl-bot", channel, rtn)
-        logging.info(rtn)
-        return rtn
-    command_cr = command_createroom
+        def created(_):
+            # Joined by the shard the room is pinned to; an offline shard
+            # joins it when it signs on
+            client = pool.client(pool.shard_for(channel))
+            if client is not None:
+                client.join(channel)
+                client.topic(channel, link)
+
+            rtn = " ".join(["Created Channel:", channel, " Video-conf:", link])
+            self.cl.log_chan("seagl-bot", channel, rtn)
+            logging.info(rtn)
+            return rtn
 
+        d = self.factory.adb.add_room(nick, link, channel, shard)
+        d.addCallback(created)
+        return d
 
+
+    @commands.command("lr")
     def command_listrooms(self, nick, channel, rest):
         """ Get list of rooms. 
             Return: string
@@ -512,12 +650,12 @@ class IRCProtocol(irc.IRCClient):
         logging.info("CMD: command_listrooms")
 
         page_num = rest
-        rtn = self.factory.db.list_rooms(page_num)
-        self.cl.log_chan("seagl-bot", channel, rtn)
-        return rtn
-    command_lr = command_listrooms        
+        d = self.factory.adb.list_rooms(page_num)
+        d.addCallback(lambda rtn: self._logReply(channel, rtn))
+        return d
 
 
+    @commands.command("st", botops=True)
     def command_shuffle(self, nick, channel, rest):
         """ Shuffle user name of a topic list and divide into groups of N size.
             Return: string
@@ -530,15 +668,49 @@ class IRCProtocol(irc.IRCClient):
 
         logging.info("CMD: command_shuffle")
 
-        if not nick in config.botops:
-            return "Operation not permitted user."
+        def shuffled(sublist_dict):
+            if isinstance(sublist_dict, str):
+                return sublist_dict
+            topic, groups = sublist_dict
+            summary = "%s: %d users in %d groups" % (
+                topic, sum(len(g) for g in groups.values()), len(groups))
+            self.cl.log_chan("seagl-bot", channel, summary)
+            logging.info("command_shuffle(): " + summary)
+            return "Groups Channels created. Find out Attendee placement by running: `!assignment <topic-name>`"
+
+        d = self.factory.adb.shuffle_users(rest)
+        d.addCallback(shuffled)
+        return d
+
+
+    @commands.command("cs", botops=True)
+    def command_cmdstats(self, nick, channel, rest):
+        """ Report per-command call counts and latency.
+            Return: string
+
+            Keyword arguments:
+            nick -- string: user nick
+            channel -- string: channel
+            rest -- string: optional command name
+        """
+
+        logging.info("CMD: command_cmdstats")
+        return self.command_registry.summary(rest.strip())
+
+
+    @commands.command("ds", botops=True)
+    def command_dbstats(self, nick, channel, rest):
+        """ Report the slowest Database methods (config.db_timing).
+            Return: string
 
-        sublist_dict = self.factory.db.shuffle_users(rest)
-        self.cl.log_chan("seagl-bot", channel, str(sublist_dict))
-        print(str(sublist_dict)) 
+            Keyword arguments:
+            nick -- string: user nick
+            channel -- string: channel
+            rest -- string: optional method name
+        """
 
-        return "Groups Channels created. Find out Attendee placement by running: `!assignment <topic-name>`"
-    command_st = command_shuffle
+        logging.info("CMD: command_dbstats")
+        return self.factory.db.timing_summary(rest.strip())
 
 
     def alarm(self, channel, msg):
@@ -585,7 +757,6 @@ class IRCProtocol(irc.IRCClient):
 
         reactor.callLater(alarm_time, self.alarm, channel, alarm_msg)
         reactor.run()
-    command_timer = command_timer
 
 
 
@@ -595,29 +766,9 @@ class IRCProtocol(irc.IRCClient):
     #    self.sendLine("NAMES %s" % channel)
 
 
-    def query_names(self):
-        """ Query the chanserv for the List of users in a channel 
-        """
-        
-        row = self.last_chan_id + 1
-
-        db = database.Database(config.sqlite_path)
-        num_channels = db.rooms_table_size()
-
-        if row > num_channels:
-            row = row % num_channels
-        
-        channel = db.get_channel_row(row)
-        if channel:
-            self.last_chan_id = row 
-            #logging.info("INFO: query_names():" + channel)
-            self.sendLine("NAMES %s" % channel)
-        else:
-            self.last_chan_id = 1
-
-
     def irc_RPL_NAMREPLY(self, prefix, params):
-        """ Called when chanserv replys to a NAMES request.
+        """ Called for each line of a NAMES reply; collected until
+            RPL_ENDOFNAMES.
 
             Keyword arguments:
             prefix -- string: irc endpoint name i.e. blah.freenode.net
@@ -626,28 +777,30 @@ class IRCProtocol(irc.IRCClient):
 
         channel = params[2].lower()
         nicklist = params[3].split(' ')
-        db = database.Database(config.sqlite_path)
+        self.membership.names(channel, nicklist, self.member_prefixes())
 
-        # Validate the data.
-        if not isinstance(nicklist, list):
-            logging.error("Error: irc_RPL_NAMREPLY(): Nicklist type error")
-            return
-        if not db.channel_exists(channel):
-            logging.error("Error: irc_RPL_NAMREPLY(): db.channel_exists")
-            return
 
-        # Write to the database channel_counts table
-        try:
-            db.add_channel_count(channel, nicklist)
-        except Exception as e:
-            logging.error("Error: rc_RPL_NAMREPLY(): " + str(e))
+    def irc_RPL_ENDOFNAMES(self, prefix, params):
+        """ End of a NAMES reply: replace the channel's tracked members.
 
-        #logging.info('Info: rc_RPL_NAMREPLY(): %s, %s' % (nicklist, channel))
-        return
+            Keyword arguments:
+            prefix -- string: irc endpoint name
+            params -- list: ['seagl-bot', '<channel>', 'End of /NAMES list.']
+        """
 
+        channel = params[1].lower()
+        drift = self.membership.names_end(channel)
+        if drift:
+            logging.info("irc_RPL_ENDOFNAMES(): %s drifted by %d nicks" % (channel, drift))
 
-    #def irc_RPL_ENDOFNAMES(self, prefix, params):
-    #    logging.info("INFO: irc_RPL_ENDOFNAMES")
+
+    def member_prefixes(self):
+        """ Return channel membership prefix characters (ISUPPORT PREFIX) """
+
+        prefixes = self.supported.getFeature("PREFIX")
+        if not prefixes:
+            return membership.DEFAULT_PREFIXES
+        return "".join(p for p, _ in prefixes.values())
 
 
     #def irc_unknown(self, prefix, command, params):
@@ -655,59 +808,148 @@ class IRCProtocol(irc.IRCClient):
     #    print ('UNKNOWN:', prefix, command, params)
 
 
+    @defer.inlineCallbacks
     def publish_metrics(self):
-        """ Write json file
+        """ Write json files. The channel counts file is only rewritten when
+            the counts changed since the last publish.
         """
 
-        db = database.Database(config.sqlite_path)
-        metric_dict = db.get_channel_count_metric()
+        # Shared state lives on the pool; metrics_version is written back
+        pool = self.factory.pool
+        try:
+            version = pool.db.counts_version
+            if version != pool.metrics_version:
+                metric_dict = pool.db.get_channel_count_metric()
+
+                for chan in config.channels_admin:
+                    metric_dict.pop(pool.channel_name(chan), None)
+
+                written = yield threads.deferToThread(pool.channel_metrics.publish, metric_dict)
+                # On a failed write, retry on the next tick
+                if written:
+                    pool.metrics_version = version
+
+            if pool.bot_metrics:
+                queue_size = yield pool.adb.msg_queue_size()
+                bot_metrics = self.bot_metrics()
+                bot_metrics["dispatcher"]["queue_size"] = int(queue_size)
+                yield threads.deferToThread(pool.bot_metrics.publish, bot_metrics)
+        except Exception as e:
+            logging.error("Error: publish_metrics(): " + str(e))
+        return 
+
 
-        for chan in config.channels_admin:
-            admin_chan = '#' + chan
-            if admin_chan in metric_dict.keys():
-                metric_dict.pop(admin_chan)
+    def bot_metrics(self):
+        """ Return dict of the bot's own runtime metrics
+        """
 
-        with open(config.metric_path, 'w') as fp:
-            json.dump(metric_dict, fp)
-        return 
+        rtn = {
+            "dispatcher": self.dispatcher.stats(),
+            "commands": self.command_registry.stats(),
+            "flood": self.factory.flood.stats(),
+            "membership": self.membership.stats(),
+            "shards": self.factory.pool.stats(),
+        }
+        if self.factory.db.timing is not None:
+            rtn["database"] = self.factory.db.timing.stats()
+        return rtn
 
 
+    @defer.inlineCallbacks
     def check_channel_limit(self):
         """ Check if nearing channel limit, and send Alert if so.
+            The limit is per connection, so any shard over it alerts.
         """
 
-        db = database.Database(config.sqlite_path)
-        metric_dict = db.get_channel_count_metric()
-        if len(metric_dict.keys()) > 105:
-            for dest in config.channels_admin:
-                if not dest.startswith('#'):
-                    dest = "#" + dest
-                    logging.warning("!!!---  "+ str(dest))
-                db.enqueue_msg(dest, "ALERT! Channel Limit Approaching")
+        adb = self.factory.adb
+        try:
+            limit = int(getattr(config, "shard_channel_limit", 105))
+            pool = self.factory.pool
+            full = ["shard %d (%s)" % (i, pool.shards[i].nickname)
+                    for i, n in enumerate(pool.loads()) if n > limit]
+            if full:
+                dests = []
+                for dest in config.channels_admin:
+                    if not dest.startswith('#'):
+                        dest = "#" + dest
+                        logging.warning("!!!---  "+ str(dest))
+                    dests.append(dest)
+                yield adb.enqueue_msgs(dests, "ALERT! Channel Limit Approaching: " + ", ".join(full))
+        except Exception as e:
+            logging.error("Error: check_channel_limit(): " + str(e))
 
 
+    @defer.inlineCallbacks
     def chan_user_audit(self):
         """ Leave inactive channels
         """
 
-        db = database.Database(config.sqlite_path)
-        chans_to_leave = db.audit_channels()
-        logging.info("chans_to_leave:" + str(chans_to_leave))
+        adb = self.factory.adb
+        try:
+            chans_to_leave = yield adb.audit_channels()
+            if not chans_to_leave:
+                return
+            logging.info("chans_to_leave:" + str(chans_to_leave))
+            pool = self.factory.pool
+            owners = dict((c, pool.shard_for(c)) for c in chans_to_leave)
+
+            removed = yield adb.remove_rooms(chans_to_leave)
+            if not removed:
+                logging.error("Error: remove_rooms(): return false")
+                return
+        except Exception as e:
+            logging.error("Error: chan_user_audit(): " + str(e))
+            return
 
-        if not db.remove_rooms(chans_to_leave):
-            logging.error("Error: remove_rooms(): return false")
-        
         for channel in chans_to_leave:
-            if not (channel in config.channels_admin and channel in config.initial_channels):
-                self.leave(channel, reason="Too Few Participants...")
+            client = pool.client(owners[channel])
+            if client is not None:
+                client.leave(channel, reason="Too Few Participants...")
         return
         
 
-class IRCFactory(protocol.ReconnectingClientFactory):
+class ShardFactory(protocol.ReconnectingClientFactory):
+    """ Connection factory for one shard of an IRCFactory pool. Shared
+        state (db, adb, flood, ...) is looked up on the pool.
+
+        Keyword arguments:
+        pool -- IRCFactory: owning pool
+        shard -- int: shard number
+        nickname -- string: nick this connection signs on with
+    """
+
+    protocol = IRCProtocol
+
+    def __init__(self, pool, shard, nickname):
+        self.pool = pool
+        self.shard = shard
+        self.nickname = nickname
+        self.client = None
+
+
+    def __getattr__(self, name):
+        return getattr(self.pool, name)
+
+
+    def buildProtocol(self, addr):
+        p = protocol.ReconnectingClientFactory.buildProtocol(self, addr)
+        p.nickname = self.nickname
+        return p
+
+
+class IRCFactory:
+    """ Pool of bot connections sharing one database.
+
+        Channels are spread over the connections by consistent hashing,
+        except the initial and admin channels, which stay on shard 0, and
+        rooms, which are pinned to the least loaded shard when created.
+        Each connection drains only its own shard of msg_queue, so each
+        gets its own send budget.
+    """
+
     def __init__(self, passwd):
-        self.protocol = IRCProtocol
-        self.protocol.password = passwd
-        self.db = database.Database(config.sqlite_path)
+        IRCProtocol.password = passwd
+        self.db = database.get_database(config.sqlite_path)
         channel_list = self.db.get_room_list()
         channel_list = channel_list + config.initial_channels + config.channels_admin
 
@@ -715,23 +957,145 @@ class IRCFactory(protocol.ReconnectingClientFactory):
             print("Channel List is empty. No channels will be joined")
             sys.exit(1)
 
+        # Started only now: its non-daemon thread pools would keep a
+        # failed startup from exiting
+        self.adb = database.AsyncDatabase(
+            self.db, reactor, readers=int(getattr(config, "sqlite_readers", 4)))
+
         self.channels = channel_list
+        self.home = set(self.channel_name(c) for c in config.initial_channels + config.channels_admin)
+
+        count = max(1, int(getattr(config, "bot_connections", 1)))
+        nicks = list(getattr(config, "bot_nicks", []))
+        nicks = nicks + [config.nickname + (str(i) if i else "") for i in range(len(nicks), count)]
+        self.shards = [ShardFactory(self, i, nicks[i]) for i in range(count)]
+        self.ring = sharding.HashRing(range(count), int(getattr(config, "shard_replicas", 64)))
+
+        self.db.set_router(self.place)
+        moved = self.db.reshard_queue()
+        if moved > 0:
+            logging.info("Re-routed %d queued messages over %d shards" % (moved, count))
+
+        self.flood = flood.FloodControl({
+            "nick": (getattr(config, "flood_nick_rate", 0.2), getattr(config, "flood_nick_burst", 5)),
+            "host": (getattr(config, "flood_host_rate", 0.5), getattr(config, "flood_host_burst", 10)),
+            "channel": (getattr(config, "flood_channel_rate", 1), getattr(config, "flood_channel_burst", 10)),
+        }, max_keys=int(getattr(config, "flood_max_keys", 4096)))
+        self.flood_costs = getattr(config, "flood_costs", {})
+
+        self.channel_metrics = metrics.MetricsPublisher(
+            config.metric_path, getattr(config, "metric_ndjson_path", ""))
+        self.metrics_version = None
+        self.bot_metrics = None
+        if getattr(config, "bot_metrics_path", ""):
+            self.bot_metrics = metrics.MetricsPublisher(config.bot_metrics_path)
+
+
+    def channel_name(self, channel):
+        channel = channel.lower()
+        if not channel.startswith('#'):
+            channel = '#' + channel
+        return channel
+
+
+    def place(self, dest):
+        """ Return the shard that owns a channel or sends to a nick.
+            Rooms are placed once and cached by the Database; use
+            shard_for() for lookups.
+        """
+
+        dest = dest.lower()
+        if dest in self.home:
+            return 0
+        shard = self.db.room_shards.get(dest)
+        if shard is not None and shard < len(self.shards):
+            return shard
+        return self.ring.node(dest)
+
+
+    def shard_for(self, dest):
+        """ Return the shard that owns a channel or sends to a nick """
+
+        return self.db.route(dest.lower())
+
+
+    def shard_rooms(self, shard):
+        """ Return list of managed channels owned by shard """
+
+        return self.db.shard_room_list(shard)
+
+
+    def shard_channels(self, shard):
+        """ Return list of every channel shard should join """
+
+        channels = self.shard_rooms(shard)
+        if shard == 0:
+            channels = channels + sorted(self.home.difference(channels))
+        return channels
+
+
+    def loads(self):
+        """ Return list of channel counts, indexed by shard """
+
+        rtn = self.db.shard_loads(len(self.shards))
+        rtn[0] += sum(1 for c in self.home if not self.db.channel_exists(c))
+        return rtn
+
+
+    def least_loaded(self):
+        """ Return the shard with the fewest channels """
+
+        loads = self.loads()
+        return loads.index(min(loads))
+
+
+    def client(self, shard):
+        """ Return the signed-on IRCProtocol of shard, or None """
+
+        return self.shards[shard].client
+
+
+    def connect(self, endpoint):
+        """ Connect every shard. Return a Deferred that fires when any
+            connection is lost.
+        """
+
+        deferreds = []
+        for shard in self.shards:
+            d = endpoint.connect(shard)
+            d.addCallback(lambda protocol: protocol.deferred)
+            deferreds.append(d)
+        return defer.DeferredList(deferreds, fireOnOneErrback=True, consumeErrors=True)
+
+
+    def stats(self):
+        """ Return {shard: dict} of load and connection state """
+
+        rtn = {}
+        loads = self.loads()
+        for shard in self.shards:
+            client = shard.client
+            rtn[str(shard.shard)] = {
+                "nick": shard.nickname,
+                "connected": client is not None,
+                "channels": loads[shard.shard],
+            }
+            if client is not None:
+                rtn[str(shard.shard)]["dispatcher"] = client.dispatcher.stats()
+                rtn[str(shard.shard)]["members"] = client.membership.stats()["members"]
+        return rtn
 
 
 def run(reactor, host, port, passwd):
     FORMAT = '%(asctime)-15s %(message)s'
-    bot_log_path = os.path.join('/home', str(getpass.getuser()), 'seagl-bot.d')
-    if not os.path.exists(bot_log_path):
-        os.mkdir(bot_log_path, 0o755)
-    bot_log = os.path.join(bot_log_path, 'bot.log')
+    bot_log = os.path.join(get_log_path(), 'bot.log')
     logging.basicConfig(filename=bot_log, level=logging.DEBUG, format=FORMAT)
+    reactor.addSystemEventTrigger("after", "shutdown", database.close_all)
 
     options = ssl.optionsForClientTLS(host)
     endpoint = endpoints.SSL4ClientEndpoint(reactor, host, port, options)
     factory = IRCFactory(passwd)
-    deferred = endpoint.connect(factory)
-    deferred.addCallback(lambda protocol: protocol.deferred)
-    return deferred
+    return factory.connect(endpoint)
 
 
 def main():
@@ -2,24 +2,94 @@
 import os
 import logging
 import datetime
+import threading
+import collections
 
 class channel_logger:
+    """ Per-channel log files with buffered writes.
 
-    def __init__(self, path):
-        self.logd = {}
+        Lines are buffered in memory by log_chan() and written out by
+        flush(), which keeps at most max_open file handles open (least
+        recently used are closed first).
+
+        Keyword arguments:
+        path -- string: directory for the channel log files
+        max_open -- int: open file handle limit
+        flush_bytes -- int: buffered size that triggers a flush
+        flusher -- callable: runs flush, e.g. reactor.callInThread.
+                   Default is to flush inline.
+    """
+
+    def __init__(self, path, max_open=32, flush_bytes=65536, flusher=None):
+        self.logd = collections.OrderedDict()
         self.path = path
+        self.max_open = max(1, int(max_open))
+        self.flush_bytes = int(flush_bytes)
+        self.flusher = flusher
+        self.pending = {}
+        self.pending_bytes = 0
+        self.flush_scheduled = False
+        self.buffer_lock = threading.Lock()
+        self.file_lock = threading.Lock()
 
     def log_chan(self, user, name, message):
         date_time = datetime.datetime.now()
         time_stamp = str(date_time.strftime("%m.%d.%y-%H:%M:%S "))
         msg = time_stamp + ":" + user + ":" + message + "\n"
 
-        file_path  = os.path.join(self.path, name)
-        try:
-            self.logd[name] = open(file_path, "a")
-            self.logd[name].write(msg)
-            self.logd[name].close()
-        except Exception as e:
-            logging.error("log_chan():"+str(e))
-            print(str(e))
+        with self.buffer_lock:
+            self.pending.setdefault(name, []).append(msg)
+            self.pending_bytes += len(msg)
+            if self.pending_bytes < self.flush_bytes or self.flush_scheduled:
+                return
+            self.flush_scheduled = True
+
+        if self.flusher:
+            self.flusher(self.flush)
+        else:
+            self.flush()
+
+    def get_handle(self, name):
+        """ Return an open append handle for name, evicting the LRU one """
+
+        fh = self.logd.pop(name, None)
+        if fh is None:
+            if len(self.logd) >= self.max_open:
+                _, old = self.logd.popitem(last=False)
+                old.close()
+            fh = open(os.path.join(self.path, name), "a")
+        self.logd[name] = fh
+        return fh
+
+    def flush(self):
+        """ Write out everything buffered so far. Safe to call from a thread. """
+
+        # Swap the buffer while holding file_lock so that concurrent
+        # flushes write their batches in the order they were taken
+        with self.file_lock:
+            with self.buffer_lock:
+                pending = self.pending
+                self.pending = {}
+                self.pending_bytes = 0
+                self.flush_scheduled = False
+
+            for name, lines in pending.items():
+                try:
+                    fh = self.get_handle(name)
+                    fh.write("".join(lines))
+                    fh.flush()
+                except Exception as e:
+                    logging.error("log_chan():"+str(e))
+                    print(str(e))
+
+    def close(self):
+        """ Flush and close every open handle """
 
+        self.flush()
+        with self.file_lock:
+            while self.logd:
+                _, fh = self.logd.popitem()
+                try:
+                    fh.close()
+                except Exception as e:
+                    logging.error("channel_logger.close():"+str(e))
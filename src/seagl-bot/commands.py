@@ -0,0 +1,163 @@
+
+import time
+import config
+import metrics
+
+from twisted.internet import defer
+from twisted.python import failure
+
+
+NOT_PERMITTED = "Operation not permitted user."
+
+
+def command(*aliases, botops=False, cost=1):
+    """ Decorator for IRCProtocol.command_* methods.
+
+        Keyword arguments:
+        aliases -- string: other names the command answers to
+        botops -- bool: only nicks in config.botops may run it
+        cost -- float: flood control tokens per call, see flood.py
+    """
+
+    def wrap(func):
+        func.command_aliases = aliases
+        func.command_botops = botops
+        func.command_cost = cost
+        return func
+    return wrap
+
+
+def registry(cls):
+    """ Class decorator: build the command registry once for cls """
+
+    cls.command_registry = CommandRegistry(cls)
+    return cls
+
+
+class Command:
+    """ One registered command and its call statistics """
+
+    def __init__(self, name, func, aliases, botops, cost=1):
+        self.name = name
+        self.func = func
+        self.aliases = tuple(aliases)
+        self.botops = botops
+        self.cost = cost
+        self.calls = 0
+        self.errors = 0
+        self.denied = 0
+        self.limited = 0
+        self.histogram = metrics.LatencyHistogram()
+
+
+    def stats(self):
+        rtn = {"calls": self.calls, "errors": self.errors, "denied": self.denied,
+               "limited": self.limited}
+        rtn.update(self.histogram.to_dict())
+        return rtn
+
+
+class CommandRegistry:
+    """ Map command names and aliases to handlers, built from the
+        command_* methods of a class.
+
+        Keyword arguments:
+        cls -- class: holds command_<name> methods, optionally decorated
+               with command()
+    """
+
+    PREFIX = "command_"
+
+    def __init__(self, cls, clock=time.monotonic):
+        self.clock = clock
+        self.commands = {}
+        self.table = {}
+        for attr in sorted(dir(cls)):
+            if not attr.startswith(self.PREFIX):
+                continue
+            func = getattr(cls, attr)
+            if not callable(func):
+                continue
+            name = attr[len(self.PREFIX):]
+            cmd = Command(name, func,
+                          getattr(func, "command_aliases", ()),
+                          getattr(func, "command_botops", False),
+                          getattr(func, "command_cost", 1))
+            self.commands[name] = cmd
+            self.table[name] = cmd
+
+        for cmd in self.commands.values():
+            for alias in cmd.aliases:
+                if alias in self.table:
+                    raise ValueError("command alias clash: " + alias)
+                self.table[alias] = cmd
+
+
+    def lookup(self, name):
+        """ Return the Command for a name or alias, or None """
+
+        return self.table.get(name)
+
+
+    def dispatch(self, protocol, cmd, nick, channel, rest):
+        """ Run cmd and record its latency once its result is ready.
+            Returns a Deferred.
+
+            Keyword arguments:
+            protocol -- IRCProtocol: instance the handler is bound to
+            cmd -- Command: from lookup()
+            nick -- string: user nick
+            channel -- string: channel
+            rest -- string: input from user
+        """
+
+        if cmd.botops and nick not in config.botops:
+            cmd.denied += 1
+            return defer.succeed(NOT_PERMITTED)
+
+        start = self.clock()
+        cmd.calls += 1
+
+        def record(result):
+            cmd.histogram.observe((self.clock() - start) * 1000.0)
+            if isinstance(result, failure.Failure):
+                cmd.errors += 1
+            return result
+
+        d = defer.maybeDeferred(cmd.func, protocol, nick, channel, rest)
+        d.addBoth(record)
+        return d
+
+
+    def stats(self):
+        """ Return {name: stats} for every command called at least once """
+
+        return dict((name, cmd.stats()) for name, cmd in sorted(self.commands.items())
+                    if cmd.calls or cmd.denied or cmd.limited)
+
+
+    def summary(self, name=""):
+        """ Return a one line per command latency summary.
+
+            Keyword arguments:
+            name -- string: optional command name or alias to report on
+        """
+
+        if name:
+            cmd = self.lookup(name)
+            if cmd is None:
+                return "Error: Unknown command " + name
+            cmds = [cmd]
+        else:
+            cmds = sorted((c for c in self.commands.values() if c.calls),
+                          key=lambda c: c.histogram.total, reverse=True)
+        if not cmds:
+            return "No commands run yet."
+
+        lines = []
+        for cmd in cmds:
+            h = cmd.histogram
+            lines.append("%s: calls=%d errors=%d denied=%d limited=%d p50=%.1fms p99=%.1fms max=%.1fms" % (
+                cmd.name, cmd.calls, cmd.errors, cmd.denied, cmd.limited,
+                h.percentile(50), h.percentile(99), h.max))
+        return "\n".join(lines)
@@ -6,7 +6,18 @@ import math
 import config
 import sqlite3
 import logging
+import array
 import random
+import hashlib
+import queue
+import threading
+import contextlib
+import collections
+import itertools
+import metrics
+
+from twisted.internet import threads
+from twisted.python.threadpool import ThreadPool
 
 ROOMS_TABLE = """
 CREATE TABLE rooms (
@@ -14,29 +25,113 @@ CREATE TABLE rooms (
     creator TEXT,
     irc_channel TEXT,
     jitsi_room TEXT,
-    Timestamp DATE DEFAULT (datetime('now','localtime'))
+    Timestamp DATE DEFAULT (datetime('now','localtime')),
+    shard INTEGER
 );
 """
 
+ROOMS_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS rooms_irc_channel ON rooms (irc_channel);",
+    "CREATE INDEX IF NOT EXISTS rooms_jitsi_room ON rooms (jitsi_room);",
+]
+
 MSG_QUEUE_TABLE = """
     CREATE TABLE IF NOT EXISTS msg_queue (
     id INTEGER PRIMARY KEY ASC, 
     destination TEXT, 
     message TEXT,
-    Timestamp DATE DEFAULT (datetime('now','localtime'))
+    Timestamp DATE DEFAULT (datetime('now','localtime')),
+    digest TEXT,
+    shard INTEGER NOT NULL DEFAULT 0
     );
 """
 
+MSG_QUEUE_INDEX = """
+    CREATE UNIQUE INDEX IF NOT EXISTS msg_queue_dedup
+    ON msg_queue (destination, digest);
+"""
+
+MSG_QUEUE_SHARD_INDEX = """
+    CREATE INDEX IF NOT EXISTS msg_queue_shard ON msg_queue (shard, id);
+"""
+
 CHANNEL_COUNTS_TABLE = """
     CREATE TABLE IF NOT EXISTS channel_counts (
     id INTEGER PRIMARY KEY ASC,
     Timestamp DATE DEFAULT (datetime('now','localtime')),
     channel TEXT,
     count INTEGER,
-    nicks TEXT
+    nicks TEXT,
+    members BLOB
+    );
+"""
+
+COUNT_NICKS_TABLE = """
+    CREATE TABLE IF NOT EXISTS count_nicks (
+    id INTEGER PRIMARY KEY ASC,
+    nick TEXT UNIQUE
     );
 """
 
+CHANNEL_COUNTS_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS channel_counts_channel ON channel_counts (channel, id);",
+    "CREATE INDEX IF NOT EXISTS channel_counts_ts ON channel_counts (Timestamp);",
+]
+
+QUESTIONS_TABLE = """
+    CREATE TABLE IF NOT EXISTS questions (
+    id INTEGER PRIMARY KEY ASC,
+    Timestamp DATE DEFAULT (datetime('now','localtime')),
+    channel TEXT,
+    seq INTEGER,
+    creator TEXT,
+    question TEXT
+    );
+"""
+
+QUESTIONS_INDEX = """
+    CREATE UNIQUE INDEX IF NOT EXISTS questions_channel_seq
+    ON questions (channel, seq);
+"""
+
+TOPICS_TABLE = """
+    CREATE TABLE IF NOT EXISTS topics (
+    id INTEGER PRIMARY KEY ASC,
+    name TEXT UNIQUE,
+    Timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+    );
+"""
+
+TOPIC_MEMBERS_TABLE = """
+    CREATE TABLE IF NOT EXISTS topic_members (
+    id INTEGER PRIMARY KEY ASC,
+    topic TEXT,
+    nick TEXT,
+    Timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+    );
+"""
+
+TOPIC_MEMBERS_INDEXES = [
+    "CREATE UNIQUE INDEX IF NOT EXISTS topic_members_topic_nick ON topic_members (topic, nick);",
+    "CREATE INDEX IF NOT EXISTS topic_members_nick ON topic_members (nick);",
+    "CREATE INDEX IF NOT EXISTS topic_members_topic_id ON topic_members (topic, id);",
+]
+
+ASSIGNMENTS_TABLE = """
+    CREATE TABLE IF NOT EXISTS assignments (
+    id INTEGER PRIMARY KEY ASC,
+    topic TEXT,
+    nick TEXT,
+    irc_channel TEXT,
+    jitsi_room TEXT
+    );
+"""
+
+ASSIGNMENTS_INDEX = """
+    CREATE UNIQUE INDEX IF NOT EXISTS assignments_topic_nick
+    ON assignments (topic, nick);
+"""
+
 CHANNEL_USER_AUDIT = """
     CREATE TABLE IF NOT EXISTS channel_user_audit (
     id INTEGER PRIMARY KEY ASC,
@@ -53,16 +148,398 @@ USER_LOGINS = """
     );
 """
 
+USER_LOGINS_INDEX = """
+    CREATE UNIQUE INDEX IF NOT EXISTS attendee_nicks_nick
+    ON attendee_nicks (nick);
+"""
+
+
+def msg_digest(msg):
+    """ Return the hex digest used to de-duplicate msg_queue rows """
+
+    return hashlib.sha1(msg.encode("utf-8", "replace")).hexdigest()
+
+
+def pack_members(ids):
+    """ Pack a set of count_nicks IDs into a compact sorted blob """
+
+    return array.array("I", sorted(ids)).tobytes()
+
+
+def unpack_members(blob):
+    """ Return frozenset of count_nicks IDs from pack_members() output """
+
+    ids = array.array("I")
+    ids.frombytes(bytes(blob))
+    return frozenset(ids)
+
+
+# SQLite connection profile: PRAGMAs plus sqlite3.connect() options.
+# Values come from config.sqlite_<key> when set.
+SQLITE_PROFILE = {
+    "journal_mode": "wal",
+    "synchronous": "normal",
+    "cache_size": -16000,
+    "mmap_size": 67108864,
+    "busy_timeout": 5000,
+    "cached_statements": 256,
+}
+
+# SQLite's own defaults, for comparison in bench.py
+SQLITE_DEFAULT_PROFILE = {
+    "journal_mode": "delete",
+    "synchronous": "full",
+    "cache_size": -2000,
+    "mmap_size": 0,
+    "busy_timeout": 5000,
+    "cached_statements": 128,
+}
+
+JOURNAL_MODES = ("delete", "truncate", "persist", "memory", "wal", "off")
+SYNCHRONOUS_LEVELS = ("off", "normal", "full", "extra")
+CHECKPOINT_MODES = ("passive", "full", "restart", "truncate")
+
+
+def sqlite_profile():
+    """ Return the connection profile: SQLITE_PROFILE overridden by config """
+
+    profile = {}
+    for key, default in SQLITE_PROFILE.items():
+        profile[key] = getattr(config, "sqlite_" + key, default)
+    return profile
+
+
+class ConnectionPool:
+    """ One writer connection plus a bounded pool of reader connections.
+
+        Readers are opened lazily, up to max_readers, and handed back to the
+        pool when the caller is done with them. Every connection gets the
+        same profile (see SQLITE_PROFILE).
+    """
+
+    # Seconds to wait for a reader when all max_readers are checked out
+    READER_WAIT = 30
+
+    def __init__(self, sqlite_path, max_readers=4, profile=None):
+        self.sqlite_path = sqlite_path
+        self.max_readers = max(1, int(max_readers))
+        self.profile = self.check_profile(profile or sqlite_profile())
+        self.num_readers = 0
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.writer = self.connect()
+
+
+    def check_profile(self, profile):
+        """ Validate a profile, since PRAGMA values can't be bound.
+            Raises ValueError on a bad value.
+        """
+
+        profile = dict(SQLITE_PROFILE, **profile)
+        profile["journal_mode"] = str(profile["journal_mode"]).lower()
+        profile["synchronous"] = str(profile["synchronous"]).lower()
+        if profile["journal_mode"] not in JOURNAL_MODES:
+            raise ValueError("sqlite journal_mode: " + profile["journal_mode"])
+        if profile["synchronous"] not in SYNCHRONOUS_LEVELS:
+            raise ValueError("sqlite synchronous: " + profile["synchronous"])
+        for key in ("cache_size", "mmap_size", "busy_timeout", "cached_statements"):
+            profile[key] = int(profile[key])
+        return profile
+
+
+    def connect(self):
+        """ Open a connection usable from any (one-at-a-time) thread """
+
+        profile = self.profile
+        connection = sqlite3.connect(self.sqlite_path, check_same_thread=False,
+                                     timeout=profile["busy_timeout"] / 1000.0,
+                                     cached_statements=profile["cached_statements"])
+        # Allow accessing row items by name
+        connection.row_factory = sqlite3.Row
+        connection.execute("PRAGMA journal_mode=%s" % profile["journal_mode"])
+        connection.execute("PRAGMA synchronous=%s" % profile["synchronous"])
+        connection.execute("PRAGMA cache_size=%d" % profile["cache_size"])
+        connection.execute("PRAGMA mmap_size=%d" % profile["mmap_size"])
+        connection.execute("PRAGMA busy_timeout=%d" % profile["busy_timeout"])
+        return connection
+
+
+    @contextlib.contextmanager
+    def reader(self):
+        """ Check out a reader connection, blocking if all are in use.
+            Raises sqlite3.OperationalError if none is free within
+            READER_WAIT seconds.
+        """
+
+        connection = None
+        try:
+            connection = self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                if self.num_readers < self.max_readers:
+                    self.num_readers += 1
+                    try:
+                        connection = self.connect()
+                    except Exception:
+                        # Give the slot back, or it is lost for good
+                        self.num_readers -= 1
+                        raise
+            if connection is None:
+                try:
+                    connection = self.idle.get(timeout=self.READER_WAIT)
+                except queue.Empty:
+                    raise sqlite3.OperationalError(
+                        "no reader connection free after %ds" % self.READER_WAIT)
+        try:
+            yield connection
+        finally:
+            self.idle.put(connection)
+
+
+    def close(self):
+        """ Close the writer and every idle reader """
+
+        with self.lock:
+            while True:
+                try:
+                    self.idle.get_nowait().close()
+                except queue.Empty:
+                    break
+            self.num_readers = 0
+            try:
+                self.writer.close()
+            except Exception as e:
+                logging.error("ConnectionPool.close(): " + str(e))
+
+
+_shared_databases = {}
+
+
+def get_database(sqlite_path):
+    """ Return the process-wide Database for sqlite_path, opening it on first use.
+
+        Keyword arguments:
+        sqlite_path -- string: path to the sqlite file
+    """
+
+    db = _shared_databases.get(sqlite_path)
+    if db is None:
+        db = Database(sqlite_path)
+        _shared_databases[sqlite_path] = db
+    return db
+
+
+def close_all():
+    """ Close every shared Database. Called on reactor shutdown. """
+
+    for db in list(_shared_databases.values()):
+        db.close()
+    _shared_databases.clear()
+
+
+class AsyncDatabase:
+    """ Deferred-returning facade over a Database.
+
+        Methods that only use pooled reader connections run in parallel on a
+        reader thread pool. Everything else touches the writer connection and
+        is serialized on a single writer thread. Any Database method can be
+        called as adb.<method>(...) and returns a Deferred.
+
+        Keyword arguments:
+        db -- Database: the wrapped database
+        reactor -- reactor: used to fire the Deferreds
+        readers -- int: max reader threads
+    """
+
+    READ_METHODS = frozenset([
+        "read_question",
+        "peek_msgs",
+        "get_room_list",
+        "list_rooms",
+        "msg_queue_size",
+    ])
+
+    def __init__(self, db, reactor, readers=4):
+        self.db = db
+        self.reactor = reactor
+        self.writer_pool = ThreadPool(1, 1, name="db-writer")
+        self.reader_pool = ThreadPool(1, max(1, int(readers)), name="db-reader")
+        self.writer_pool.start()
+        self.reader_pool.start()
+        reactor.addSystemEventTrigger("during", "shutdown", self.stop)
+
+
+    def __getattr__(self, name):
+        func = getattr(self.db, name)
+        if name in self.READ_METHODS:
+            pool = self.reader_pool
+        else:
+            pool = self.writer_pool
+
+        def call(*args, **kwargs):
+            return threads.deferToThreadPool(self.reactor, pool, func, *args, **kwargs)
+        return call
+
+
+    def stop(self):
+        """ Stop the thread pools, letting queued work finish first """
+
+        self.reader_pool.stop()
+        self.writer_pool.stop()
+
+
+# Latency histogram bounds (ms) for Database methods
+DB_BUCKETS_MS = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 25, 50, 100, 250, 1000)
+
+
+class MethodTimer:
+    """ Call counts, latency and rows touched for every public method of a
+        Database, installed by wrapping the methods on the instance.
+
+        Times are inclusive: a method calling another method is charged for
+        both. Rows touched are the length of the result for READ_METHODS
+        and the writer's total_changes delta for everything else, which is
+        approximate when other threads write at the same time.
+
+        Keyword arguments:
+        db -- Database: instance to instrument
+    """
+
+    SKIP = frozenset(["close", "timing_summary"])
+
+    def __init__(self, db):
+        self.db = db
+        self.lock = threading.Lock()
+        self.methods = {}
+        for name in dir(type(db)):
+            if name.startswith("_") or name in self.SKIP:
+                continue
+            if callable(getattr(type(db), name)):
+                setattr(db, name, self.wrap(name, getattr(db, name)))
+
+
+    def wrap(self, name, func):
+        record = {"calls": 0, "errors": 0, "rows": 0,
+                  "histogram": metrics.LatencyHistogram(DB_BUCKETS_MS)}
+        self.methods[name] = record
+        reads = name in AsyncDatabase.READ_METHODS
+        connection = self.db.connection
+        clock = time.perf_counter
+
+        def timed(*args, **kwargs):
+            changes = connection.total_changes
+            start = clock()
+            result = None
+            ok = False
+            try:
+                result = func(*args, **kwargs)
+                ok = True
+                return result
+            finally:
+                ms = (clock() - start) * 1000.0
+                if not reads:
+                    rows = connection.total_changes - changes
+                elif isinstance(result, (list, tuple, dict)):
+                    rows = len(result)
+                else:
+                    rows = 0
+                with self.lock:
+                    record["calls"] += 1
+                    record["rows"] += rows
+                    if not ok:
+                        record["errors"] += 1
+                    record["histogram"].observe(ms)
+        timed.__name__ = name
+        timed.__doc__ = func.__doc__
+        return timed
+
+
+    def stats(self):
+        """ Return {method: stats} for every method called at least once """
+
+        rtn = {}
+        with self.lock:
+            for name, record in sorted(self.methods.items()):
+                if not record["calls"]:
+                    continue
+                h = record["histogram"]
+                rtn[name] = {
+                    "calls": record["calls"],
+                    "errors": record["errors"],
+                    "rows": record["rows"],
+                    "total_ms": round(h.total, 3),
+                }
+                rtn[name].update(h.to_dict())
+        return rtn
+
 
 class Database:
-    def __init__(self, sqlite_path):
+    def __init__(self, sqlite_path, profile=None):
         exists = os.path.exists(sqlite_path) and os.path.getsize(sqlite_path) > 0
         dirname = os.path.dirname(sqlite_path)
         if not os.path.exists(dirname):
             os.makedirs(dirname)
-        self.connection = sqlite3.connect(sqlite_path)
-        # Allow accessing row items by name
-        self.connection.row_factory = sqlite3.Row
+        self.pool = ConnectionPool(sqlite_path, getattr(config, "sqlite_readers", 4), profile)
+        self.connection = self.pool.writer
+
+        # Opt-in per-method timing. When off, methods are not wrapped at all.
+        self.timing = None
+        if str(getattr(config, "db_timing", "False")).lower() in ("1", "true", "yes"):
+            self.timing = MethodTimer(self)
+
+        # Known attendee nicks, plus new ones not yet written to attendee_nicks
+        self.attendees = set()
+        self.pending_attendees = []
+        self.attendee_lock = threading.Lock()
+
+        # Interned NAMES nicks (count_nicks table) and the last stored
+        # membership of each channel, so unchanged snapshots are skipped
+        self.nick_ids = {}
+        self.nick_names = {}
+        self.last_members = {}
+
+        # Topic registry: {topic: {nick: None}} in join order, plus
+        # cached renderings for !lt and !ts
+        self.topics = {}
+        self.topics_lock = threading.Lock()
+        self.topic_list_str = None
+        self.topic_subs_str = {}
+
+        # Shuffle results: {topic: {nick: (irc_channel, jitsi_room)}}
+        self.assignments = {}
+
+        # Number of questions asked in each channel: {channel: count}
+        self.question_counts = {}
+
+        # Latest snapshot of every channel: {channel: [count, nicks]}
+        self.channel_latest = {}
+        self.counts_lock = threading.Lock()
+        # Bumped whenever get_channel_count_metric() output may have changed
+        self.counts_version = 0
+
+        # Managed channels: {irc_channel: rooms.id}, in rooms table order,
+        # plus the rendered !listrooms pages for the current room set
+        self.room_channels = {}
+        # Connection shard pinned to a room at creation: {irc_channel: shard}
+        self.room_shards = {}
+        # Maps a msg_queue destination to its connection shard; see
+        # bot.IRCFactory. None puts everything on shard 0.
+        self.shard_for = None
+        # Owning shard of every managed channel and each shard's channels
+        # in rooms table order; see place_room()
+        self.room_owners = {}
+        self.rooms_by_shard = {}
+        self.rooms_lock = threading.Lock()
+        self.rooms_version = 0
+        self.room_pages = {}
+        self.room_page_starts = None
+
+        # Inactivity auditor: last audit_window counts of every managed
+        # channel since it entered the low state, and the channels in the
+        # low state (channel_user_audit)
+        self.activity = {}
+        self.low_channels = {}
+
         if not exists:
             logging.info("Initializing new DB")
             self.create_db()
@@ -79,6 +556,80 @@ class Database:
                 room = config.JITSI_PREFIX + ca
                 rtn = self.add_room("seagl-bot", room, chan)
 
+        self.migrate_db()
+        self.load_attendees()
+        self.load_rooms()
+        self.load_count_nicks()
+        self.load_question_counts()
+        self.load_topics()
+        self.load_assignments()
+        self.load_channel_audit()
+
+
+    def close(self):
+        """ Close all connections held by this Database """
+
+        self.flush_attendees()
+        if self.pool.profile["journal_mode"] == "wal":
+            self.checkpoint("truncate")
+        self.pool.close()
+
+
+    def checkpoint(self, mode=None):
+        """ Checkpoint the WAL into the database file.
+            Return (busy, wal_pages, checkpointed_pages), None if not in WAL
+            mode or on error.
+
+            Keyword arguments:
+            mode -- string: passive, full, restart or truncate.
+                    Default config.sqlite_checkpoint_mode.
+        """
+
+        if self.pool.profile["journal_mode"] != "wal":
+            return None
+        mode = str(mode or getattr(config, "sqlite_checkpoint_mode", "passive")).lower()
+        if mode not in CHECKPOINT_MODES:
+            logging.error("ERROR: checkpoint(): bad mode " + mode)
+            return None
+
+        try:
+            row = self.connection.execute("PRAGMA wal_checkpoint(%s)" % mode).fetchone()
+        except Exception as e:
+            logging.error("ERROR: checkpoint(): " + str(e))
+            return None
+        busy, wal_pages, done = row[0], row[1], row[2]
+        if busy:
+            logging.warning("checkpoint(): busy, %d of %d WAL pages copied" % (done, wal_pages))
+        return (busy, wal_pages, done)
+
+
+    def timing_summary(self, method="", limit=5):
+        """ Return one line per instrumented method, by total time.
+
+            Keyword arguments:
+            method -- string: optional method to report on
+            limit -- int: lines returned when no method is given
+        """
+
+        if self.timing is None:
+            return "Database timing is off. Set db_timing = 'True' in config."
+        stats = self.timing.stats()
+        if method:
+            if method not in stats:
+                return "No calls recorded for " + method
+            names = [method]
+        else:
+            names = sorted(stats, key=lambda k: stats[k]["total_ms"], reverse=True)[:limit]
+        if not names:
+            return "No database calls recorded yet."
+
+        lines = []
+        for name in names:
+            st = stats[name]
+            lines.append("%s: calls=%d total=%.1fms p50=%.2fms p99=%.2fms rows=%d" % (
+                name, st["calls"], st["total_ms"], st["p50_ms"], st["p99_ms"], st["rows"]))
+        return "\n".join(lines)
+
 
     def create_db(self):
         """ Create DB Tables
@@ -110,25 +661,131 @@ class Database:
             logging.error("ERROR: create_db(): CHANNEL_USER_AUDIT " + str(e))
 
 
-    def question_table_count(self, qtable):
-        """ Retrun question count size
+    def migrate_db(self):
+        """ Bring an existing DB up to the current schema. Safe to re-run.
+        """
+
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute("PRAGMA table_info(msg_queue)")
+            columns = [row[1] for row in cursor.fetchall()]
+            if "digest" not in columns:
+                logging.info("Adding msg_queue.digest column")
+                cursor.execute("ALTER TABLE msg_queue ADD COLUMN digest TEXT")
+            if "shard" not in columns:
+                logging.info("Adding msg_queue.shard column")
+                cursor.execute("ALTER TABLE msg_queue ADD COLUMN shard INTEGER NOT NULL DEFAULT 0")
+
+            cursor.execute("SELECT id, message FROM msg_queue WHERE digest IS NULL")
+            rows = cursor.fetchall()
+            cursor.executemany("UPDATE msg_queue SET digest=? WHERE id=?",
+                               [(msg_digest(str(r[1])), r[0]) for r in rows])
+            cursor.execute("""DELETE FROM msg_queue WHERE id NOT IN
+                              (SELECT MIN(id) FROM msg_queue GROUP BY destination, digest)""")
+            cursor.execute(MSG_QUEUE_INDEX)
+            cursor.execute(MSG_QUEUE_SHARD_INDEX)
+            self.connection.commit()
+        except Exception as e:
+            logging.error("ERROR: migrate_db(): msg_queue " + str(e))
+
+        try:
+            cursor.execute("PRAGMA table_info(rooms)")
+            if "shard" not in [row[1] for row in cursor.fetchall()]:
+                logging.info("Adding rooms.shard column")
+                cursor.execute("ALTER TABLE rooms ADD COLUMN shard INTEGER")
+            for index in ROOMS_INDEXES:
+                cursor.execute(index)
+            self.connection.commit()
+        except Exception as e:
+            logging.error("ERROR: migrate_db(): rooms " + str(e))
+
+        try:
+            cursor.execute(USER_LOGINS)
+            cursor.execute("""DELETE FROM attendee_nicks WHERE id NOT IN
+                              (SELECT MIN(id) FROM attendee_nicks GROUP BY nick)""")
+            cursor.execute(USER_LOGINS_INDEX)
+            self.connection.commit()
+        except Exception as e:
+            logging.error("ERROR: migrate_db(): attendee_nicks " + str(e))
+
+        try:
+            cursor.execute(CHANNEL_COUNTS_TABLE)
+            cursor.execute("PRAGMA table_info(channel_counts)")
+            columns = [row[1] for row in cursor.fetchall()]
+            if "members" not in columns:
+                logging.info("Adding channel_counts.members column")
+                cursor.execute("ALTER TABLE channel_counts ADD COLUMN members BLOB")
+            cursor.execute(COUNT_NICKS_TABLE)
+            for index in CHANNEL_COUNTS_INDEXES:
+                cursor.execute(index)
+            self.connection.commit()
+        except Exception as e:
+            logging.error("ERROR: migrate_db(): channel_counts " + str(e))
+
+        try:
+            cursor.execute(QUESTIONS_TABLE)
+            cursor.execute(QUESTIONS_INDEX)
+            cursor.execute("""SELECT name FROM sqlite_master WHERE type='table'
+                              AND name LIKE 'questions\\_%' ESCAPE '\\'""")
+            old_tables = [str(r[0]) for r in cursor.fetchall()]
+            with self.connection:
+                for tbl in old_tables:
+                    logging.info("Moving " + tbl + " into questions table")
+                    cursor.execute("""INSERT OR IGNORE INTO questions (Timestamp, channel, seq, creator, question)
+                                      SELECT Timestamp, irc_channel, id, creator, question FROM %s""" % tbl)
+                    cursor.execute("DROP TABLE %s" % tbl)
+        except Exception as e:
+            logging.error("ERROR: migrate_db(): questions " + str(e))
 
-            qtable -- string: 
+        try:
+            cursor.execute(TOPICS_TABLE)
+            cursor.execute(TOPIC_MEMBERS_TABLE)
+            for index in TOPIC_MEMBERS_INDEXES:
+                cursor.execute(index)
+            cursor.execute("""SELECT name FROM sqlite_master WHERE type='table'
+                              AND name LIKE '%\\_list' ESCAPE '\\'""")
+            old_tables = [str(r[0]) for r in cursor.fetchall()]
+            with self.connection:
+                for tbl in old_tables:
+                    topic = tbl[:-len("_list")]
+                    logging.info("Moving " + tbl + " into topic_members table")
+                    cursor.execute("INSERT OR IGNORE INTO topics (name) VALUES (?)", (topic,))
+                    cursor.execute("""INSERT OR IGNORE INTO topic_members (topic, nick, Timestamp)
+                                      SELECT ?, user_id, Timestamp FROM %s ORDER BY id""" % tbl, (topic,))
+                    cursor.execute("DROP TABLE %s" % tbl)
+        except Exception as e:
+            logging.error("ERROR: migrate_db(): topics " + str(e))
+
+        try:
+            cursor.execute(ASSIGNMENTS_TABLE)
+            cursor.execute(ASSIGNMENTS_INDEX)
+            cursor.execute("""SELECT name FROM sqlite_master WHERE type='table'
+                              AND name LIKE '%\\_shuffle' ESCAPE '\\'""")
+            old_tables = [str(r[0]) for r in cursor.fetchall()]
+            with self.connection:
+                for tbl in old_tables:
+                    topic = tbl[:-len("_shuffle")]
+                    logging.info("Moving " + tbl + " into assignments table")
+                    cursor.execute("""INSERT OR REPLACE INTO assignments (topic, nick, irc_channel, jitsi_room)
+                                      SELECT ?, nick, irc_channel, jitsi_room FROM %s ORDER BY id""" % tbl,
+                                   (topic,))
+                    cursor.execute("DROP TABLE %s" % tbl)
+        except Exception as e:
+            logging.error("ERROR: migrate_db(): assignments " + str(e))
+        cursor.close()
+
+
+    def load_question_counts(self):
+        """ Load per-channel question counts from the questions table
         """
 
-        rtn = 0
+        cursor = self.connection.cursor()
         try:
-            cursor = self.connection.cursor()
-            qry = "SELECT COUNT(ALL) FROM %s" % qtable
-            cursor.execute(qry)
-            val = cursor.fetchall()
-            if len(val) < 1:
-                rtn = 0
-            rtn = int(val[0][0])
-        except Exception as e:
-            logging.error("ERROR: question_table_count(): " + qry + ":" + str(e))
+            cursor.execute("SELECT channel, MAX(seq) FROM questions GROUP BY channel")
+            self.question_counts = dict((str(r[0]), int(r[1])) for r in cursor.fetchall())
+        except Exception as e:
+            logging.error("ERROR: load_question_counts(): " + str(e))
         cursor.close()
-        return int(rtn)
 
 
     def clear_question_list(self, channel):
@@ -141,10 +798,9 @@ class Database:
         cursor = self.connection.cursor()
 
         try:
-            qtable = 'questions_' + channel.replace('#','').replace('-','_')
-            query = """DELETE FROM %s""" % qtable
-            cursor.execute(query)
+            cursor.execute("DELETE FROM questions WHERE channel=?", (channel,))
             self.connection.commit()
+            self.question_counts.pop(channel, None)
             rtn = True
         except Exception as e:
             logging.error("Error: clear_question_list()" + str(e))
@@ -162,25 +818,25 @@ class Database:
         """
 
         rtn = ""
-        qtable = 'questions_' + channel.replace('#','').replace('-','_')
-        qcount = self.question_table_count(qtable)
+        qcount = self.question_counts.get(channel, 0)
         if qcount == 0 or qcount < 0 or qnum > qcount:
             return "No Questions Found"
 
-        cursor = self.connection.cursor()
-        try:
-            qtable = 'questions_' + channel.replace('#','').replace('-','_')
-            query = "SELECT Timestamp, id, creator, question FROM %s WHERE id=%s" % (qtable, str(qnum))
-            cursor.execute(query)
-            rows = cursor.fetchall()
-        except Exception as e:
-            logging.error("read_question(): "  + str(e))
-        cursor.close()
+        rows = []
+        with self.pool.reader() as connection:
+            cursor = connection.cursor()
+            try:
+                query = "SELECT Timestamp, creator, question FROM questions WHERE channel=? AND seq=?"
+                cursor.execute(query, (channel, int(qnum)))
+                rows = cursor.fetchall()
+            except Exception as e:
+                logging.error("read_question(): "  + str(e))
+            cursor.close()
 
-        if len(rows[0]) > 0:
+        if len(rows) > 0:
             timestamp = rows[0][0]
-            username  = rows[0][2]
-            question  = rows[0][3]
+            username  = rows[0][1]
+            question  = rows[0][2]
             rtn = "".join(["[", str(qnum), "/", str(qcount), "] ", timestamp, " : ", username, ": ", question ])
         return rtn
 
@@ -195,22 +851,14 @@ class Database:
         """
 
         rtn = False
-        qtable = 'questions_' + channel.replace('#','').replace('-','_')
+        seq = self.question_counts.get(channel, 0) + 1
 
         cursor = self.connection.cursor()
         try:
-            query = """CREATE TABLE IF NOT EXISTS %s (
-                        id INTEGER PRIMARY KEY ASC, 
-                        Timestamp DATE DEFAULT (datetime('now','localtime')),
-                        creator TEXT, irc_channel TEXT, question TEXT); """ % qtable
-            cursor.execute(query)
-        except Exception as e:
-            logging.error("Error: add_question(): create table: " + str(e))
-
-        try:
-            query = """INSERT INTO %s (creator, irc_channel, question) VALUES (?, ?, ?)""" % qtable
-            cursor.execute(query, (nick, channel, question))
+            query = """INSERT INTO questions (channel, seq, creator, question) VALUES (?, ?, ?, ?)"""
+            cursor.execute(query, (channel, seq, nick, question))
             self.connection.commit()
+            self.question_counts[channel] = seq
             rtn = True
         except Exception as e:
             logging.error("Error: add_question(): insert: " + str(e))
@@ -218,43 +866,163 @@ class Database:
         return rtn
 
 
-    def store_user_login(self, nick):
-        """ Store/Record User nicks in attendee_nicks table
-            reutrn True if nick was stored
-            return False if already present
-
-            nick - : String of user nick
+    def load_rooms(self):
+        """ Load the managed channel list from the rooms table
         """
+
         cursor = self.connection.cursor()
         try:
-            query = "SELECT nick FROM attendee_nicks WHERE nick='%s'" % nick
-            cursor.execute(query)
+            cursor.execute("SELECT id, irc_channel, shard FROM rooms ORDER BY id ASC")
             rows = cursor.fetchall()
-            if (len(rows)) > 0:
-                return False
+            channels = dict((str(r[1]), r[0]) for r in rows)
+            with self.rooms_lock:
+                self.room_channels = channels
+                self.room_shards = dict((str(r[1]), r[2]) for r in rows if r[2] is not None)
+                self.place_rooms()
+                self.rooms_changed()
         except Exception as e:
-            logging.error("Exception: store_user_login() lookup:" + str(e))
-            cursor.close()
-            return False
+            logging.error("Exception: load_rooms():" + str(e))
+        cursor.close()
+
+
+    def rooms_changed(self):
+        """ Invalidate room derived caches. Caller holds rooms_lock. """
+
+        self.rooms_version += 1
+        self.room_pages = {}
+        self.room_page_starts = None
+        self.counts_version += 1
+
+
+    def room_list(self):
+        """ Return list of managed channels from memory, in rooms table order """
+
+        with self.rooms_lock:
+            return list(self.room_channels)
+
+
+    def place_room(self, channel):
+        """ Cache the owning shard of channel, so shard_for() runs once per
+            room rather than on every lookup. Caller holds rooms_lock.
+        """
+
+        shard = 0 if self.shard_for is None else self.shard_for(channel)
+        self.room_owners[channel] = shard
+        self.rooms_by_shard.setdefault(shard, {})[channel] = None
+
+
+    def unplace_room(self, channel):
+        """ Drop channel from the shard caches. Caller holds rooms_lock. """
+
+        shard = self.room_owners.pop(channel, None)
+        if shard is not None:
+            self.rooms_by_shard[shard].pop(channel, None)
+
+
+    def place_rooms(self):
+        """ Rebuild the shard caches. Caller holds rooms_lock. """
+
+        self.room_owners = {}
+        self.rooms_by_shard = {}
+        for channel in self.room_channels:
+            self.place_room(channel)
+
 
+    def set_router(self, shard_for):
+        """ Set the destination to shard callable and re-place every room
+
+            Keyword arguments:
+            shard_for -- callable: shard_for(dest) -> int
+        """
+
+        with self.rooms_lock:
+            self.shard_for = shard_for
+            self.place_rooms()
+
+
+    def shard_room_list(self, shard):
+        """ Return list of managed channels owned by shard, in rooms table order """
+
+        with self.rooms_lock:
+            return list(self.rooms_by_shard.get(shard, ()))
+
+
+    def shard_loads(self, shards):
+        """ Return list of managed channel counts, indexed by shard
+
+            Keyword arguments:
+            shards -- int: number of shards
+        """
+
+        with self.rooms_lock:
+            return [len(self.rooms_by_shard.get(i, ())) for i in range(shards)]
+
+
+    def load_attendees(self):
+        """ Load every nick in attendee_nicks into the in-memory registry
+        """
+
+        cursor = self.connection.cursor()
         try:
-            query = "INSERT INTO attendee_nicks (nick) VALUES (?)" 
-            cursor.execute(query,(nick,))
-            self.connection.commit()
+            cursor.execute("SELECT nick FROM attendee_nicks")
+            nicks = set(str(r[0]) for r in cursor.fetchall())
+            with self.attendee_lock:
+                self.attendees |= nicks
         except Exception as e:
-            logging.error("Exception:  store_user_login():" + str(e))
+            logging.error("Exception: load_attendees():" + str(e))
         cursor.close()
+
+
+    def store_user_login(self, nick):
+        """ Record User nick in the attendee registry. In-memory only, the
+            nick is written to attendee_nicks by the next flush_attendees().
+            reutrn True if nick is new
+            return False if already present
+
+            nick - : String of user nick
+        """
+
+        with self.attendee_lock:
+            if nick in self.attendees:
+                return False
+            self.attendees.add(nick)
+            self.pending_attendees.append(nick)
         return True
 
 
+    def flush_attendees(self):
+        """ Write newly seen nicks to attendee_nicks in one transaction.
+            Return number of nicks written.
+        """
+
+        with self.attendee_lock:
+            nicks = self.pending_attendees
+            self.pending_attendees = []
+        if not nicks:
+            return 0
+
+        try:
+            with self.connection:
+                self.connection.executemany(
+                    "INSERT OR IGNORE INTO attendee_nicks (nick) VALUES (?)",
+                    [(n,) for n in nicks])
+        except Exception as e:
+            logging.error("Exception:  flush_attendees():" + str(e))
+            with self.attendee_lock:
+                self.pending_attendees = nicks + self.pending_attendees
+            return 0
+        return len(nicks)
+
+
 
-    def add_room(self, nick, room, channel):
+    def add_room(self, nick, room, channel, shard=None):
         """ Add room and channel to DB 'rooms' table
 
             Keyword arguments:
             nick -- string: user nick 
             room -- string: room name
             channel -- string: channel name
+            shard -- int: connection shard to pin the channel to
         """
         channel = channel.lower()
         room = room.lower()
@@ -283,32 +1051,119 @@ class Database:
                 logging.error("Exception: DB verification of room: " + str(e))
                 return False
 
-            try:
-                query = """INSERT INTO rooms (creator, irc_channel, jitsi_room) VALUES (?, ?, ?)"""
-                room = room.strip()
-                channel = channel.strip()
-                cursor.execute(query, (nick, channel, room))
-            except Exception as e:
-                logging.error("Exception: DB insert room/channel: " + str(e))
-                return False        
+            try:
+                query = """INSERT INTO rooms (creator, irc_channel, jitsi_room, shard) VALUES (?, ?, ?, ?)"""
+                room = room.strip()
+                channel = channel.strip()
+                cursor.execute(query, (nick, channel, room, shard))
+                room_id = cursor.lastrowid
+            except Exception as e:
+                logging.error("Exception: DB insert room/channel: " + str(e))
+                return False        
+
+        with self.rooms_lock:
+            self.room_channels[channel] = room_id
+            if shard is not None:
+                self.room_shards[channel] = shard
+            self.place_room(channel)
+            self.rooms_changed()
+        return True
+
+
+    def add_rooms(self, nick, rooms):
+        """ Add many rooms in one transaction, skipping any whose channel or
+            room already exists. Return number added, -1 on error.
+
+            Keyword arguments:
+            nick -- string: user nick 
+            rooms -- list: (room, channel) tuples
+        """
+
+        added = []
+        cursor = self.connection.cursor()
+        try:
+            with self.connection:
+                # Skip existing channels and rooms in memory, then insert
+                # in bulk; checking each row in SQL costs twice as much
+                cursor.execute("SELECT irc_channel, jitsi_room FROM rooms")
+                seen = set()
+                for r in cursor.fetchall():
+                    seen.add(str(r[0]))
+                    seen.add(str(r[1]))
+                params = []
+                for room, channel in rooms:
+                    channel = channel.lower().strip()
+                    room = room.lower().strip()
+                    if channel in seen or room in seen:
+                        continue
+                    seen.add(channel)
+                    seen.add(room)
+                    params.append((nick, channel, room))
+
+                cursor.execute("SELECT COALESCE(MAX(id), 0) FROM rooms")
+                last_id = cursor.fetchone()[0]
+                cursor.executemany("INSERT INTO rooms (creator, irc_channel, jitsi_room) VALUES (?, ?, ?)", params)
+                # The writer holds the transaction: every newer row is ours
+                cursor.execute("SELECT id, irc_channel FROM rooms WHERE id > ? ORDER BY id ASC", (last_id,))
+                added = [(str(r[1]), r[0]) for r in cursor.fetchall()]
+        except Exception as e:
+            logging.error("Exception: add_rooms(): " + str(e))
+            cursor.close()
+            return -1
+        cursor.close()
+
+        if added:
+            with self.rooms_lock:
+                for channel, room_id in added:
+                    self.room_channels[channel] = room_id
+                    self.place_room(channel)
+                self.rooms_changed()
+        return len(added)
+
+
+    def remove_rooms(self, room_lst):
+        """ Remove rooms, and their audit state, in one transaction
+            room_lst -- list
+        """
+
+        if not room_lst:
+            return True
+
+        rows = [(r,) for r in room_lst]
+        try:
+            with self.connection:
+                self.connection.executemany("DELETE FROM rooms WHERE irc_channel=?", rows)
+                self.connection.executemany("DELETE FROM channel_user_audit WHERE channel=?", rows)
+        except Exception as e:
+            logging.error("Error: remove_rooms(): " + str(e))
+            return False
+
+        with self.rooms_lock:
+            for r in room_lst:
+                self.room_channels.pop(r, None)
+                self.room_shards.pop(r, None)
+                self.unplace_room(r)
+            self.rooms_changed()
+        for r in room_lst:
+            self.activity.pop(r, None)
+            self.low_channels.pop(r, None)
         return True
 
 
-    def remove_rooms(self, room_lst):
-        """ Remove rooms from rooms table
-            room_lst -- list
+    def load_assignments(self):
+        """ Load shuffle assignments into memory
         """
 
-        rtn = False
+        assignments = {}
         cursor = self.connection.cursor()
         try:
-            for r in room_lst:
-                cursor.execute("DELETE FROM rooms WHERE irc_channel=?", (r,))
-                self.connection.commit()
-            rtn = True
+            cursor.execute("SELECT topic, nick, irc_channel, jitsi_room FROM assignments")
+            for r in cursor.fetchall():
+                assignments.setdefault(str(r[0]), {})[str(r[1])] = (str(r[2]), str(r[3]))
         except Exception as e:
-            logging.error("Error: remove_rooms(): " + str(e))
-        return rtn
+            logging.error("ERROR: load_assignments(): " + str(e))
+        cursor.close()
+        self.assignments = assignments
 
 
     def get_assignment(self, nick, topic):
@@ -318,38 +1173,15 @@ class Database:
         """
 
         rtn = "No Assignment Found."
-        tbl = topic + "_shuffle"
-
-        """ Check if table exists """
-        try:
-            cursor = self.connection.cursor()
-            cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=\'" + tbl + "\';")
-            rows = cursor.fetchall()
-            if len(rows) < 1:
-                cursor.close()
-                return rtn
-        except Exception as e:
-            logging.error("ERROR: get_assignment(): "+str(e))
-            cursor.close()
-            return
-        cursor.close()
-
-        rows = ''
-        with self.connection:
-            query = "SELECT nick, irc_channel, jitsi_room FROM %s" % tbl
-            try:
-                cursor = self.connection.cursor()
-                cursor.execute(query)
-                rows = cursor.fetchall()
-                if not len(rows) > 0:
-                    return "No data in list"
-            except Exception as e:
-                logging.error("get_room_list():'"+ query + "':" + str(e))
-            cursor.close()
+        topic_assignments = self.assignments.get(topic)
+        if topic_assignments is None:
+            return rtn
+        if not topic_assignments:
+            return "No data in list"
 
-        for r in rows:
-            if str(r[0]) == str(nick):
-                rtn = "".join(["  Channel:", str(r[1]), "   Jitsi Room:" ,str(r[2]) ])
+        assignment = topic_assignments.get(str(nick))
+        if assignment:
+            rtn = "".join(["  Channel:", assignment[0], "   Jitsi Room:", assignment[1]])
         return rtn
 
 
@@ -357,10 +1189,10 @@ class Database:
         """ Return list strings: list of room names """
 
         lst = []
-        with self.connection:
+        with self.pool.reader() as connection:
             query = "SELECT irc_channel FROM rooms"
             try:
-                cursor = self.connection.cursor()
+                cursor = connection.cursor()
                 cursor.execute(query)
                 rooms = cursor.fetchall()
                 num_rooms = len(rooms)
@@ -377,6 +1209,9 @@ class Database:
     def list_rooms(self, page_num):
         """ Return a string of room/chanel info 
 
+            Pages are read with a keyset query on rooms.id and cached until
+            a room is added or removed.
+
             Keyword arguments:
             page_num -- string:  
         """
@@ -390,60 +1225,116 @@ class Database:
         if page_num <= 0:
             page_num = int(1)
 
-        with self.connection:
-            query = "SELECT irc_channel, jitsi_room FROM rooms" 
-            try:
-                cursor = self.connection.cursor() 
-                cursor.execute(query)
-                rooms = cursor.fetchall()
-                num_rooms = len(rooms)
-                num_pages = math.ceil(len(rooms) / LINES_PER_PAGE)
-
-                stop = page_num * LINES_PER_PAGE
-                start = stop - LINES_PER_PAGE
-
-                if num_rooms < stop:
-                    stop = num_rooms
-                if num_rooms < start:
-                    return ''
-   
-                rtn = "Listing Page: " + str(page_num) + "/"+ str(num_pages) + " of room list" + " - Run Command: `!lr 2` for page 2, etc.."
-                for room in rooms[start:stop]:
-                    rtn += "\n" + '{:<13} {:<13}'.format(str(room[0]), str(room[1]))
-            except Exception as e:
-                logging.error("list_rooms():" + str(page_num) + ":" + str(e))
-            return rtn
+        with self.rooms_lock:
+            version = self.rooms_version
+            if page_num in self.room_pages:
+                return self.room_pages[page_num]
+            if self.room_page_starts is None:
+                self.room_page_starts = list(self.room_channels.values())[::LINES_PER_PAGE]
+            page_starts = self.room_page_starts
+            num_rooms = len(self.room_channels)
+
+        num_pages = math.ceil(num_rooms / LINES_PER_PAGE)
+        start = (page_num - 1) * LINES_PER_PAGE
+        if num_rooms < start:
+            return ''
+
+        rooms = []
+        if page_num <= len(page_starts):
+            with self.pool.reader() as connection:
+                query = "SELECT irc_channel, jitsi_room FROM rooms WHERE id >= ? ORDER BY id ASC LIMIT ?"
+                try:
+                    cursor = connection.cursor() 
+                    cursor.execute(query, (page_starts[page_num - 1], LINES_PER_PAGE))
+                    rooms = cursor.fetchall()
+                    cursor.close()
+                except Exception as e:
+                    logging.error("list_rooms():" + str(page_num) + ":" + str(e))
+                    return rtn
+
+        rtn = "Listing Page: " + str(page_num) + "/"+ str(num_pages) + " of room list" + " - Run Command: `!lr 2` for page 2, etc.."
+        for room in rooms:
+            rtn += "\n" + '{:<13} {:<13}'.format(str(room[0]), str(room[1]))
+
+        with self.rooms_lock:
+            if self.rooms_version == version:
+                self.room_pages[page_num] = rtn
+        return rtn
      
 
-    def dequeue_msg(self):
-        """ Return tuple representing first row in msg_queue table 
-            The entry will be removed from the table.
+    def route(self, dest):
+        """ Return the connection shard that sends to dest """
+
+        shard = self.room_owners.get(dest)
+        if shard is not None:
+            return shard
+        if self.shard_for is None:
+            return 0
+        return self.shard_for(dest)
+
 
-            tuple format: (prim_key, destination, message)
+    def reshard_queue(self):
+        """ Re-route queued messages, e.g. after the number of connections
+            changed. Return number of rows moved, -1 on error.
         """
 
         try:
-            cursor = self.connection.cursor()
-            select_query = "SELECT * FROM msg_queue ORDER BY ROWID ASC LIMIT 1;"
-            cursor.execute(select_query)
+            rows = self.connection.execute("SELECT id, destination, shard FROM msg_queue").fetchall()
+            moved = [(self.route(str(r[1])), r[0]) for r in rows]
+            moved = [m for m, r in zip(moved, rows) if m[0] != r[2]]
+            with self.connection:
+                self.connection.executemany("UPDATE msg_queue SET shard=? WHERE id=?", moved)
+        except Exception as e:
+            logging.error("reshard_queue():" + str(e))
+            return -1
+        return len(moved)
 
-            rows = cursor.fetchall()
-            if len(rows) < 1:
-                return () 
 
-            rtn = (str(rows[0][0]), str(rows[0][1]), str(rows[0][2]))
-        except Exception as e:
-            logging.error("dequeue(): '" + str(select_query) + "'" + str(e))
-        cursor.close()
+    def peek_msgs(self, limit, shard=None):
+        """ Return list of the oldest msg_queue rows without removing them.
+
+            list format: [(prim_key, destination, message), ...]
+
+            Keyword arguments:
+            limit -- int: max rows to return
+            shard -- int: only rows for this connection shard. Default all.
+        """
+
+        rtn = []
+        with self.pool.reader() as connection:
+            try:
+                cursor = connection.cursor()
+                if shard is None:
+                    qry = "SELECT id, destination, message FROM msg_queue ORDER BY id ASC LIMIT ?"
+                    cursor.execute(qry, (int(limit),))
+                else:
+                    qry = "SELECT id, destination, message FROM msg_queue WHERE shard=? ORDER BY id ASC LIMIT ?"
+                    cursor.execute(qry, (int(shard), int(limit)))
+                rtn = [(r[0], str(r[1]), str(r[2])) for r in cursor.fetchall()]
+                cursor.close()
+            except Exception as e:
+                logging.error("peek_msgs():" + str(e))
+        return rtn
+
+
+    def delete_msgs(self, ids):
+        """ Remove sent rows from msg_queue in one transaction
 
+            Keyword arguments:
+            ids -- list: msg_queue primary keys
+        """
+
+        if not ids:
+            return True
+
+        rtn = False
         try:
-            cursor = self.connection.cursor()
-            delete_querey = "DELETE FROM msg_queue WHERE ID='"+str(rows[0][0])+"';"
-            cursor.execute(delete_querey)
-            self.connection.commit()
+            with self.connection:
+                self.connection.executemany("DELETE FROM msg_queue WHERE id=?",
+                                            [(i,) for i in ids])
+            rtn = True
         except Exception as e:
-            logging.error("dequeue(): '" + str(delete_querey) + "'" + str(e))
-        cursor.close()
+            logging.error("delete_msgs():" + str(e))
         return rtn
 
 
@@ -457,110 +1348,89 @@ class Database:
 
         rtn = False
 
-        # RETURN EARLY IF MESSAGE IS DUPLICATE
-        try:
-            cursor = self.connection.cursor()
-            qry = "SELECT destination, message from msg_queue"
-            cursor.execute(qry)
-            rows = cursor.fetchall()
-            for row in rows:
-                dest_cmpr = str(row[0])
-                msg_cmpr = str(row[1])
-                if (dest_cmpr == dest) and (msg_cmpr == msg):
-                    cursor.close()
-                    return rtn
-        except Exception as e:
-            logging.error("enqueue():" + qry + ":" + str(e))
-        cursor.close()
-
+        # Duplicates of a pending (destination, message) are ignored by the
+        # msg_queue_dedup unique index.
         try:
             cursor = self.connection.cursor()
-            qry = "INSERT INTO msg_queue (destination, message) VALUES (?, ?)"
-            cursor.execute(qry, (dest, msg))
+            qry = "INSERT OR IGNORE INTO msg_queue (destination, message, digest, shard) VALUES (?, ?, ?, ?)"
+            cursor.execute(qry, (dest, msg, msg_digest(msg), self.route(dest)))
             self.connection.commit()
-            rtn = True
+            rtn = cursor.rowcount == 1
         except Exception as e:
             logging.error("enqueue():" + qry + ":" + str(e))
         cursor.close()
         return rtn
 
 
-    def get_channel_row(self, row):
-        """ Retrun row from rooms table
-            row -- : int?
+    def enqueue_msgs(self, dests, msg):
+        """ Queue one message for many destinations in one transaction.
+            Return number of messages queued, -1 on error.
+
+            Destinations repeated in dests, or already holding msg in the
+            queue, are skipped.
+
+            Keyword arguments:
+            dests -- list: channel or handle names
+            msg -- string: message to be sent
         """
 
-        rtn = ""
-        rid = int(row)-1
+        digest = msg_digest(msg)
+        rows = [(dest, msg, digest, self.route(dest)) for dest in dict.fromkeys(dests)]
+        if not rows:
+            return 0
+
         try:
-            cursor = self.connection.cursor()
-            query = "SELECT irc_channel FROM rooms"
-            cursor.execute(query)
-            val = cursor.fetchall()
-            rtn = str(val[rid][0])
+            with self.connection:
+                before = self.connection.total_changes
+                qry = "INSERT OR IGNORE INTO msg_queue (destination, message, digest, shard) VALUES (?, ?, ?, ?)"
+                self.connection.executemany(qry, rows)
+                return self.connection.total_changes - before
         except Exception as e:
-            logging.error("ERROR: get_channel_from_id():" + str(e))
-        cursor.close()
-        
-        #logging.info("get_channel_row() Returning " + str(rtn))
-        return rtn
+            logging.error("enqueue_msgs():" + str(e))
+            return -1
 
 
-    def channel_counts_table_size(self):
-        """ Return channel_counts table size
+    def msg_queue_size(self):
+        """ Return msg_queue table size
         """
 
-        rtn = 0
-        try:
-            cursor = self.connection.cursor()
-            qry = "SELECT COUNT(ALL) FROM channel_counts"
-            cursor.execute(qry)
-            val = cursor.fetchall()
-            if len(val) < 1:
-                rtn = 0
-            rtn = int(val[0][0])
-        except Exception as e:
-            logging.error("ERROR: channel_counts_table_size(): " + qry + ":" + str(e))
-        cursor.close()
-        return int(rtn)
+        with self.pool.reader() as connection:
+            rtn = 0
+            try:
+                cursor = connection.cursor()
+                qry = "SELECT COUNT(ALL) FROM msg_queue"
+                cursor.execute(qry)
+                val = cursor.fetchall()
+                if len(val) < 1:
+                    rtn = 0
+                rtn = str(val[0][0])
+            except Exception as e:
+                logging.error("msg_queue_size:" + qry + ":" + str(e))
+            cursor.close()
+            return str(rtn)
 
 
-    def rooms_table_size(self):
-        """ Return rooms table size
+    def load_topics(self):
+        """ Load the topic registry from the topics and topic_members tables
         """
 
-        rtn = 0
+        topics = {}
+        cursor = self.connection.cursor()
         try:
-            cursor = self.connection.cursor()
-            qry = "SELECT COUNT(ALL) FROM rooms"
-            cursor.execute(qry)
-            val = cursor.fetchall()
-            if len(val) < 1:
-                rtn = 0
-            rtn = int(val[0][0])
-        except Exception as e:
-            logging.error("ERROR: msg_queue_size(): " + qry + ":" + str(e))
+            cursor.execute("SELECT name FROM topics")
+            for row in cursor.fetchall():
+                topics[str(row[0])] = {}
+            cursor.execute("SELECT topic, nick FROM topic_members ORDER BY id ASC")
+            for row in cursor.fetchall():
+                topics.setdefault(str(row[0]), {})[str(row[1])] = None
+        except Exception as e:
+            logging.error("ERROR: load_topics(): " + str(e))
         cursor.close()
-        return int(rtn)
-        
 
-    def msg_queue_size(self):
-        """ Return msg_queue table size
-        """
-
-        rtn = 0
-        try:
-            cursor = self.connection.cursor()
-            qry = "SELECT COUNT(ALL) FROM msg_queue"
-            cursor.execute(qry)
-            val = cursor.fetchall()
-            if len(val) < 1:
-                rtn = 0
-            rtn = str(val[0][0])
-        except Exception as e:
-            logging.error("msg_queue_size:" + qry + ":" + str(e))
-        cursor.close()
-        return str(rtn)
+        with self.topics_lock:
+            self.topics = topics
+            self.topic_list_str = None
+            self.topic_subs_str = {}
 
 
     def join_topic(self, nick, lst):
@@ -571,84 +1441,44 @@ class Database:
             lst -- string: name of topic list 
         """
 
-        lst = lst + '_list'
-        rtn = False
-        table_exists = True 
-
-        """ Check if table exists """
-        try:
-            cursor = self.connection.cursor()
-            cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=\'" + lst + "\';")
-            rows = cursor.fetchall()
-            if len(rows) < 1:
-                table_exists = False
-        except Exception as e:
-            logging.error("ERROR: join_topic(): "+str(e))
-            cursor.close()
-            return
-        cursor.close()
-
+        with self.topics_lock:
+            members = self.topics.get(lst)
+            if members is not None and nick in members:
+                return False
 
         """ Check if user is in botops"""
-        if not table_exists:
+        if members is None:
             try:
                 config.botops.index(nick)
             except Exception as e:
                 return "Topic list creation Not permitted"
 
-
-        """ Create table """
-        try:
-            cursor = self.connection.cursor()
-            create_table = "CREATE TABLE IF NOT EXISTS "+lst+" (id INTEGER PRIMARY KEY ASC, user_id TEXT, Timestamp DATETIME DEFAULT CURRENT_TIMESTAMP);"
-            cursor.execute(create_table)
-        except Exception as e:
-            logging.error("join_topic(): '"+ create_table + "'" + str(e))
-        cursor.close()
-
-
-        """ Check if user is already in list """
-        try:
-            cursor = self.connection.cursor()
-            cursor.execute("SELECT user_id FROM "+lst+" WHERE user_id=?", (nick,))
-            rows = cursor.fetchall()
-            if len(rows) > 0:
-                return False
-        except Exception as e:
-            logging.error("join_topic(): '"+ query + "'" + str(e)) 
-        cursor.close()
-
-
         """ Add nick to list  """
         try:
-            cursor = self.connection.cursor()
-            qry = "INSERT INTO " + lst + " (user_id) VALUES (?)"
-            cursor.execute(qry, (nick,))
-            self.connection.commit()
+            with self.connection:
+                self.connection.execute("INSERT OR IGNORE INTO topics (name) VALUES (?)", (lst,))
+                self.connection.execute("INSERT OR IGNORE INTO topic_members (topic, nick) VALUES (?, ?)",
+                                        (lst, nick))
         except Exception as e:
-            logging.error("ERROR: join_topic():" + qry + ":" + str(e))
-        cursor.close()
+            logging.error("ERROR: join_topic():" + str(e))
+            return False
+
+        with self.topics_lock:
+            if lst not in self.topics:
+                self.topics[lst] = {}
+                self.topic_list_str = None
+            self.topics[lst][nick] = None
+            self.topic_subs_str.pop(lst, None)
+        return True
 
 
     def list_topics(self):
         """ Return string of topics """
 
-        rtn = ""
-        lst = []
-        cursor = self.connection.cursor()
-        try:
-            cursor = self.connection.cursor()
-            cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name LIKE '%_list';")
-            rows = cursor.fetchall()
-            for tbl in rows:
-                    t = tbl[0].replace("_list","")
-                    lst.append(str(t))
-            lst = sorted(lst,  key=str.lower)
-            rtn = ", ".join(lst)
-        except Exception as e:
-            logging.error("ERROR: list_topics():" + str(e))
-        cursor.close()
-        return rtn
+        with self.topics_lock:
+            if self.topic_list_str is None:
+                self.topic_list_str = ", ".join(sorted(self.topics, key=str.lower))
+            return self.topic_list_str
 
 
     def topic_subs(self, nick, lst):
@@ -659,20 +1489,70 @@ class Database:
             lst   -- list
         """
 
-        rtn = ""
+        with self.topics_lock:
+            if lst not in self.topics:
+                return "Could not find topic list"
+            rtn = self.topic_subs_str.get(lst)
+            if rtn is None:
+                rtn = "".join(" " + n for n in self.topics[lst])
+                self.topic_subs_str[lst] = rtn
+            return rtn
 
-        lst = lst + '_list'
-        cursor = self.connection.cursor()
+
+    def topic_members(self, lst):
+        """ Return list of nicks subscribed to a topic, in join order """
+
+        with self.topics_lock:
+            return list(self.topics.get(lst, ()))
+
+
+    def topic_member_chunks(self, topic, chunk_size=500):
+        """ Yield lists of up to chunk_size nicks subscribed to a topic, in
+            join order, read straight from topic_members.
+
+            Each chunk is a separate keyset query on a pooled reader, so no
+            connection or transaction is held between chunks.
+
+            Keyword arguments:
+            topic -- string: topic name
+            chunk_size -- int: max nicks per chunk
+        """
+
+        chunk_size = max(1, int(chunk_size))
+        qry = "SELECT id, nick FROM topic_members WHERE topic=? AND id>? ORDER BY id ASC LIMIT ?"
+        last_id = 0
+        while True:
+            with self.pool.reader() as connection:
+                rows = connection.execute(qry, (topic, last_id, chunk_size)).fetchall()
+            if not rows:
+                return
+            last_id = rows[-1][0]
+            yield [str(r[1]) for r in rows]
+            if len(rows) < chunk_size:
+                return
+
+
+    def enqueue_topic(self, topic, msg, chunk_size=500):
+        """ Queue msg for every subscriber of a topic, one transaction per
+            chunk of subscribers. Return number queued, -1 on error.
+
+            Keyword arguments:
+            topic -- string: topic name
+            msg -- string: message to be sent
+            chunk_size -- int: subscribers per transaction
+        """
+
+        queued = 0
         try:
-            cursor.execute("SELECT * FROM " + lst)
-            rows = cursor.fetchall()
-            for row in rows:
-                rtn = rtn + " " + str(row[1])
+            for chunk in self.topic_member_chunks(topic, chunk_size):
+                n = self.enqueue_msgs(chunk, msg)
+                if n < 0:
+                    return -1
+                queued += n
         except Exception as e:
-            logging.error("ERROR: topic_subs(): "+str(e))
-            rtn =  "Could not find topic list"
-        cursor.close()
-        return rtn
+            logging.error("ERROR: enqueue_topic(): " + str(e))
+            return -1
+        return queued
 
 
     def shuffle_users(self, args):
@@ -692,11 +1572,10 @@ class Database:
             return "Error: Missing required args <topic-name> and <group-size>"
        
         topic = lst[0]
-        topic_table = lst[0] + '_list'
         group_size = lst[1]
-        if not group_size.isdigit():
+        if not group_size.isdigit() or int(group_size) < 1:
             return "Error: group-size is not an integer"
-        if not self.topic_exists(topic_table):
+        if not self.topic_exists(topic):
             return "Error: Topic not found."
 
         rtnd = self.do_shuffle(topic, group_size)
@@ -706,44 +1585,37 @@ class Database:
 
 
     def create_shuffled_table(self, topic, shuff_dict):
-        """ Create shuffled table for topic
+        """ Replace the assignments of topic with shuff_dict
             topic -- : string
             shuff_dict -- : dict
         """
 
         rtn = False
-        top_shuff_tbl = topic + "_shuffle" 
-
-        """ Wipe table if it exists"""
-        try:
-            cursor = self.connection.cursor()
-            query = "SELECT name FROM sqlite_master WHERE type='table' AND name=\'%s\';" % top_shuff_tbl
-            cursor.execute(query)
-            rows = cursor.fetchall()
-            if len(rows) > 0:
-                query = "DELETE FROM %s" % top_shuff_tbl
-                cursor.execute(query)
-                self.connection.commit()
-            else:
-                query = """CREATE TABLE IF NOT EXISTS %s (
-                        id INTEGER PRIMARY KEY ASC, 
-                        nick TEXT, irc_channel TEXT, jitsi_room); """ % top_shuff_tbl
-                cursor.execute(query)
-        except Exception as e:
-            logging.error("ERROR: topic_exists():"+str(e))
-
+        topic_assignments = {}
+        rows = []
+        for group, users in shuff_dict.items():
+            irc_chan = "".join(["#seagl-", topic, "_", group])
+            jitsi_room = "".join([config.JITSI_PREFIX, "seagl-", topic, "_", group])
+            topic_assignments.update(dict.fromkeys(users, (irc_chan, jitsi_room)))
+            rows.extend(zip(itertools.repeat(topic), users,
+                            itertools.repeat(irc_chan), itertools.repeat(jitsi_room)))
+        cursor = self.connection.cursor()
         try:
-            for group in shuff_dict:
-                user_list = shuff_dict[group]
-                for user in user_list:
-                    irc_chan = "".join(["#seagl-", topic, "_", group])
-                    jitsi_room = "".join([config.JITSI_PREFIX, "seagl-", topic, "_", group])
-                    query = "INSERT INTO %s (nick, irc_channel, jitsi_room) VALUES (?, ?, ?)" % top_shuff_tbl
-                    cursor.execute(query, (user, irc_chan, jitsi_room))
-                    self.connection.commit()
-                    rtn = True
+            with self.connection:
+                cursor.execute("DELETE FROM assignments WHERE topic=?", (topic,))
+                # Build the unique index once after the load, rather than
+                # updating it at a random page for every row
+                cursor.execute("DROP INDEX IF EXISTS assignments_topic_nick")
+                query = "INSERT INTO assignments (topic, nick, irc_channel, jitsi_room) VALUES (?, ?, ?, ?)"
+                cursor.executemany(query, rows)
+                cursor.execute(ASSIGNMENTS_INDEX)
+            # Swap in a new dict so concurrent readers see old or new, never half
+            assignments = dict(self.assignments)
+            assignments[topic] = topic_assignments
+            self.assignments = assignments
+            rtn = True
         except Exception as e:
-            logging.error("ERROR: topic_exists():"+str(e))
+            logging.error("ERROR: create_shuffled_table():"+str(e))
         cursor.close()
 
         return rtn  
@@ -755,43 +1627,28 @@ class Database:
             group_size -- : int
         """
 
-        topic_table = topic + "_list"
+        # READ ALL USER IDS FROM TOPIC REGISTRY
+        user_list = self.topic_members(topic)
+        if not user_list:
+            return {}
 
-        # READ ALL USER IDS FROM TOPIC TABLE
-        user_list = []
-        try:
-            cursor = self.connection.cursor()
-            cursor.execute("SELECT * FROM " + topic_table)
-            rows = cursor.fetchall()
-            for row in rows:
-                user_list.append(str(row[1]))
-        except Exception as e:
-            logging.error("ERROR: shuffle_users(): "+str(e))
-            return "do_shuffle(): Error" + str(e)
-        cursor.close()
-        
-        # RANDOMIZE sublists
-        num_groups = int(len(user_list) / int(group_size))
+        # Randomize (Fisher-Yates, O(n)), then deal users out round-robin
+        # so group sizes differ by at most one.
+        random.shuffle(user_list)
+        num_groups = max(1, len(user_list) // int(group_size))
         group_dict = {}
         for group in range(num_groups):
-            if str(group) not in group_dict.keys():
-                group_dict[str(group)] = []
-
-        # Randomize
-        for i in range(len(user_list)):
-            group = int(i % num_groups)
-            b = len(user_list)-1
-            r = random.randint(0, b)
-            ruser = user_list.pop(r)
-            logging.info("group:"+ str(group) + " " + ruser)
-            group_dict[str(group)].append(ruser)
-
-        logging.info(str(group_dict))
+            group_dict[str(group)] = user_list[group::num_groups]
+        logging.info("do_shuffle(): " + topic + ": " + str(len(user_list)) +
+                     " users in " + str(num_groups) + " groups")
+
+        rooms = []
         for k in group_dict.keys():
             channel = "".join(["#seagl-", topic, "_", k])
             room = "".join([config.JITSI_PREFIX, "seagl-", topic, "_", k])
-            if not self.add_room('seagl-bot', room, channel):
-                logging.error("Error: shuffle_users() add_room" )
+            rooms.append((room, channel))
+        if self.add_rooms('seagl-bot', rooms) < 0:
+            logging.error("Error: shuffle_users() add_rooms" )
         return group_dict 
 
 
@@ -802,17 +1659,8 @@ class Database:
             topic_name -- string 
         """
 
-        rtn = False
-        try:
-            cursor = self.connection.cursor()
-            cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=\'" + topic_name + "\';")
-            rows = cursor.fetchall()
-            if len(rows) > 0:
-                rtn = True 
-        except Exception as e:
-            logging.error("ERROR: topic_exists():"+str(e))
-        cursor.close()
-        return rtn
+        with self.topics_lock:
+            return topic_name in self.topics
 
 
     def channel_exists(self, chan):
@@ -822,21 +1670,67 @@ class Database:
             chan -- string 
         """
 
-        rtn = False
+        with self.rooms_lock:
+            return chan in self.room_channels
+
+
+    def load_count_nicks(self):
+        """ Load interned nicks and each channel's latest stored membership
+        """
+
+        cursor = self.connection.cursor()
         try:
-            cursor = self.connection.cursor()
-            cursor.execute("SELECT irc_channel FROM rooms WHERE irc_channel=\'" + chan + "\';")
-            rows = cursor.fetchall()
-            if len(rows) > 0:
-                rtn = True
+            cursor.execute("SELECT id, nick FROM count_nicks")
+            for row in cursor.fetchall():
+                self.nick_ids[str(row[1])] = row[0]
+                self.nick_names[row[0]] = str(row[1])
+
+            cursor.execute("""SELECT channel, count, nicks, members FROM channel_counts WHERE id IN
+                              (SELECT MAX(id) FROM channel_counts GROUP BY channel)""")
+            latest = {}
+            for row in cursor.fetchall():
+                channel = str(row[0])
+                nicks = row[2]
+                if row[3] is not None:
+                    members = unpack_members(row[3])
+                    self.last_members[channel] = (row[1], members)
+                    nicks = ",".join(self.nick_names.get(i, "") for i in sorted(members))
+                latest[channel] = [row[1], nicks]
+            with self.counts_lock:
+                self.channel_latest = latest
         except Exception as e:
-            logging.error("ERROR: topic_exists():"+str(e))
+            logging.error("ERROR: load_count_nicks(): " + str(e))
         cursor.close()
-        return rtn
+
+
+    def intern_nicks(self, cursor, nicklist, new):
+        """ Return list of count_nicks IDs for nicklist, adding new nicks.
+            New nicks are collected in 'new'; the caller adds them to the
+            caches once the transaction has committed.
+
+            Keyword arguments:
+            cursor -- sqlite3.Cursor: on the writer connection
+            nicklist -- list
+            new -- dict: {nick: id} inserted so far in this transaction
+        """
+
+        ids = []
+        for nick in nicklist:
+            nick_id = self.nick_ids.get(nick)
+            if nick_id is None:
+                nick_id = new.get(nick)
+            if nick_id is None:
+                cursor.execute("INSERT INTO count_nicks (nick) VALUES (?)", (nick,))
+                nick_id = cursor.lastrowid
+                new[nick] = nick_id
+            ids.append(nick_id)
+        return ids
 
 
     def add_channel_count(self, channel, nicklist):
-        """ Add channel and count to channel_counts table
+        """ Add channel and count to channel_counts table. Members are stored
+            as a packed array of count_nicks IDs, and only when the channel's
+            membership changed since its last row.
 
             Keyword arguments:
             channel -- string 
@@ -844,114 +1738,178 @@ class Database:
             nicklist -- list
         """
 
-        count = str(len(nicklist))
-        nicks = ",".join(nicklist)
-        rtn = False
+        return self.add_channel_counts({channel: nicklist}) >= 0
+
+
+    def add_channel_counts(self, snapshots):
+        """ add_channel_count() for many channels in one transaction.
+            Return number of channels whose membership changed, -1 on error.
 
+            Keyword arguments:
+            snapshots -- dict: {channel: nicklist}
+        """
+
+        changed = []
+        new_nicks = {}
+        cursor = self.connection.cursor()
         try:
-            cursor = self.connection.cursor()
-            query = """INSERT INTO channel_counts (channel, count, nicks) VALUES (?, ?, ?)"""
-            cursor.execute(query, (channel, count, nicks))
-            self.connection.commit()
-            rtn = True
+            with self.connection:
+                query = """INSERT INTO channel_counts (channel, count, members) VALUES (?, ?, ?)"""
+                for channel, nicklist in snapshots.items():
+                    count = len(nicklist)
+                    members = frozenset(self.intern_nicks(cursor, nicklist, new_nicks))
+                    if self.last_members.get(channel) == (count, members):
+                        continue
+                    cursor.execute(query, (channel, count, pack_members(members)))
+                    changed.append((channel, count, members, nicklist))
         except Exception as e:
-            logging.error("ERROR: "+str(e))
+            logging.error("ERROR: add_channel_counts(): "+str(e))
+            cursor.close()
+            return -1
         cursor.close()
-        return rtn
-    
-        
-    def get_channel_count_metric(self):
-        """ return a dict of channel counts data 
+
+        # Rolled back IDs must never reach the caches
+        for nick, nick_id in new_nicks.items():
+            self.nick_ids[nick] = nick_id
+            self.nick_names[nick_id] = nick
+
+        if changed:
+            for channel, count, members, nicklist in changed:
+                self.last_members[channel] = (count, members)
+            with self.counts_lock:
+                for channel, count, members, nicklist in changed:
+                    self.channel_latest[channel] = [count, ",".join(nicklist)]
+                self.counts_version += 1
+        return len(changed)
+
+
+    def prune_channel_counts(self):
+        """ Apply the channel_counts retention and downsampling policy.
+            The latest row of every channel is always kept.
+            Return number of rows deleted.
         """
 
-        rtn_dict = {}
-        row_count = self.channel_counts_table_size()
-        num_channels = self.rooms_table_size()
+        retention = int(getattr(config, "channel_counts_retention_hours", 72))
+        downsample_after = int(getattr(config, "channel_counts_downsample_after_hours", 6))
+        bucket = max(1, int(getattr(config, "channel_counts_downsample_minutes", 15))) * 60
+        latest = "SELECT MAX(id) FROM channel_counts GROUP BY channel"
 
-        if row_count < num_channels:
-            limit = str(row_count)
-        else:
-            limit = str(num_channels)
- 
-        rows = []
+        deleted = 0
+        cursor = self.connection.cursor()
         try:
-            query = "SELECT * FROM channel_counts ORDER BY id DESC LIMIT " + str(limit)
-            cursor = self.connection.cursor()
-            cursor.execute(query)
-            rows = cursor.fetchall()
+            with self.connection:
+                if retention > 0:
+                    cursor.execute("""DELETE FROM channel_counts
+                                      WHERE Timestamp < datetime('now', 'localtime', ?)
+                                      AND id NOT IN (%s)""" % latest,
+                                   ("-%d hours" % retention,))
+                    deleted += cursor.rowcount
+
+                # Keep the last row per channel per bucket for older rows
+                cursor.execute("""DELETE FROM channel_counts
+                                  WHERE Timestamp < datetime('now', 'localtime', ?)
+                                  AND id NOT IN (%s)
+                                  AND id NOT IN (SELECT MAX(id) FROM channel_counts
+                                                 GROUP BY channel, CAST(strftime('%%s', Timestamp) AS INTEGER) / ?)""" % latest,
+                               ("-%d hours" % downsample_after, bucket))
+                deleted += cursor.rowcount
         except Exception as e:
-            logging.error("ERROR: db.get_channel_count_metric(): "+ str(e))
+            logging.error("ERROR: prune_channel_counts(): " + str(e))
         cursor.close()
+        logging.info("prune_channel_counts(): deleted " + str(deleted))
+        return deleted
 
-        if len(rows) > 0:
-            for row in rows:
-                channel = row[2]
-                count = row[3]
-                nicklist = row[4]
-                rtn_dict[str(channel)] = [count, nicklist]
 
-        return rtn_dict
+    def get_channel_count_metric(self):
+        """ return a dict of channel counts data: the latest snapshot of
+            every managed channel, from memory
 
+            dict format: { <chan-name>: [count, "nick1,nick2..."] }
+        """
 
-    def channel_user_audit_table_dict(self):
-        """ return a dict of channel counts data from channel_user_audit table
+        rooms = self.room_list()
+        with self.counts_lock:
+            latest = self.channel_latest
+            return dict((c, list(latest[c])) for c in rooms if c in latest)
 
-            Keyword arguments:
+
+    def get_channel_counts(self):
+        """ return dict of { <chan-name>: count } for every managed channel
         """
 
-        rtn_dict = {}
-        rows = []
+        rooms = self.room_list()
+        with self.counts_lock:
+            latest = self.channel_latest
+            return dict((c, latest[c][0]) for c in rooms if c in latest)
+
+
+    def load_channel_audit(self):
+        """ Load the low state channels from channel_user_audit """
+
+        low = {}
         try:
-            query = "SELECT channel, count  FROM channel_user_audit"
-            cursor = self.connection.cursor()
-            cursor.execute(query)
-            rows = cursor.fetchall()
+            for r in self.connection.execute("SELECT channel, count FROM channel_user_audit"):
+                low[str(r[0])] = r[1]
         except Exception as e:
-            logging.error("ERROR: db.get_channel_count_metric(): "+ str(e))
-        cursor.close()
+            logging.error("ERROR: load_channel_audit(): " + str(e))
+        self.low_channels = low
 
-        if len(rows) > 0:
-            for row in rows:
-                channel = row[0]
-                count = row[1]
-                rtn_dict[str(channel)] = count
-
-        return rtn_dict
 
+    def audit_channels(self):
+        """ Add the current counts to each channel's sliding window and
+            return list of channels inactive for the whole window.
 
-    def audit_channels(self): 
-        """ return list of channels flagged for inactivity.
+            A channel enters the low state when its count drops below
+            channel_audit_low and only leaves it once the count reaches
+            channel_audit_high. It is flagged once it has been low for
+            channel_audit_window audits in a row; the window restarts each
+            time a channel enters the low state, so one low sample never
+            flags it. channel_user_audit holds the low state channels and
+            is only written when a channel changes state.
         """
 
-        rtn_lst = []
-        """ channel_counts = { <chan-name>: [count, [user1, user2...]] } """
-        channel_counts = self.get_channel_count_metric()
-        """ audit_table = { <chan-name>: <count>}  """
-        audit_table = self.channel_user_audit_table_dict()        
-
-        if len(audit_table.keys()) == 0:
-            rtn_lst = []
+        window = max(1, int(getattr(config, "channel_audit_window", 3)))
+        low_water = int(getattr(config, "channel_audit_low", 3))
+        high_water = max(low_water, int(getattr(config, "channel_audit_high", 5)))
+        keep = set("#" + c.lstrip("#").lower()
+                   for c in list(config.initial_channels) + list(config.channels_admin))
 
-        # COMPARE
-        for chan in audit_table.keys():
-            if chan in channel_counts.keys():
-                if audit_table[chan] < 3 and channel_counts[chan][0] < 3:
-                    rtn_lst.append(chan)
-                   
-        try:
-            cursor = self.connection.cursor()
-            query = """DELETE FROM channel_user_audit"""
-            cursor.execute(query)
-            self.connection.commit()
+        channel_counts = self.get_channel_counts()
+        for chan in list(self.activity):
+            if chan not in channel_counts:
+                del self.activity[chan]
 
-            query = """INSERT INTO channel_user_audit (channel, count) VALUES (?, ?)"""
-            for k in channel_counts.keys(): 
-                usr_count = str(channel_counts[k][0])
-                if int(usr_count) < 3:
-                    cursor.execute(query,(k, usr_count))
-                    self.connection.commit()
-        except Exception as e:
-            logging.error("Error: audit_channels(): " + str(e))
-        cursor.close()
-        return rtn_lst        
+        entered = []
+        left = []
+        rtn_lst = []
+        for chan, count in channel_counts.items():
+            samples = self.activity.get(chan)
+            if samples is None or samples.maxlen != window:
+                samples = collections.deque(samples or (), maxlen=window)
+                self.activity[chan] = samples
+
+            if chan in self.low_channels:
+                if count >= high_water:
+                    del self.low_channels[chan]
+                    left.append((chan,))
+            elif count < low_water:
+                self.low_channels[chan] = count
+                entered.append((chan, count))
+                samples.clear()
+            samples.append(count)
+
+            if (chan in self.low_channels and chan not in keep
+                    and len(samples) == window):
+                rtn_lst.append(chan)
+
+        if entered or left:
+            try:
+                with self.connection:
+                    self.connection.executemany(
+                        "DELETE FROM channel_user_audit WHERE channel=?", left)
+                    self.connection.executemany(
+                        "INSERT INTO channel_user_audit (channel, count) VALUES (?, ?)", entered)
+            except Exception as e:
+                logging.error("Error: audit_channels(): " + str(e))
+        return rtn_lst
 
@@ -0,0 +1,195 @@
+
+import time
+import logging
+import collections
+
+from twisted.internet import defer
+
+
+class TokenBucket:
+    """ Classic token bucket: 'rate' tokens per second, at most 'burst' saved up.
+    """
+
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate = float(rate)
+        self.burst = max(1.0, float(burst))
+        self.clock = clock
+        self.tokens = self.burst
+        self.stamp = clock()
+
+
+    def refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+
+    def available(self):
+        """ Return the number of whole tokens that can be spent now """
+
+        self.refill()
+        return int(self.tokens)
+
+
+    def consume(self, n=1):
+        """ Spend n tokens. Return False (and spend nothing) if short. """
+
+        self.refill()
+        if self.tokens < n:
+            return False
+        self.tokens -= n
+        return True
+
+
+class Dispatcher:
+    """ Drain msg_queue within a send budget, packing several destinations
+        of the same message into one PRIVMSG when the server allows it.
+
+        Keyword arguments:
+        client -- IRCClient: connection used to send, with lineRate None so
+                  lines go out as they are sent; its lines_out counter, if
+                  any, is used to charge messages split over several lines
+        db -- AsyncDatabase: holds the msg_queue table
+        rate -- float: lines per second
+        burst -- int: lines that may be sent back to back
+        max_targets -- int: upper bound on targets packed into one line
+        shard -- int: only drain rows routed to this connection shard
+    """
+
+    WINDOW = 60
+
+    def __init__(self, client, db, rate=1.0, burst=4, max_targets=4, shard=None):
+        self.client = client
+        self.db = db
+        self.shard = shard
+        self.bucket = TokenBucket(rate, burst)
+        self.max_targets = max(1, int(max_targets))
+        self.lines_sent = 0
+        self.messages_sent = 0
+        self.recent = collections.deque()
+
+
+    def targets_per_line(self):
+        """ Return how many PRIVMSG targets the server accepts per line,
+            from ISUPPORT TARGMAX or MAXTARGETS, capped at max_targets.
+        """
+
+        limit = None
+        supported = getattr(self.client, "supported", None)
+        if supported is not None:
+            targmax = supported.getFeature("TARGMAX") or {}
+            if "PRIVMSG" in targmax:
+                limit = targmax["PRIVMSG"] or self.max_targets
+            elif supported.getFeature("MAXTARGETS"):
+                limit = int(supported.getFeature("MAXTARGETS"))
+        if not limit:
+            return 1
+        return max(1, min(int(limit), self.max_targets))
+
+
+    def pack(self, rows, per_line):
+        """ Group queued rows into lines: [(targets, message, ids), ...]
+
+            Rows with the same message are merged into one group unless a
+            destination already has a row in a later group; then a new
+            group is started, so each destination still gets its
+            messages in queue order.
+
+            Keyword arguments:
+            rows -- list: (id, destination, message) tuples, oldest first
+            per_line -- int: max targets per line
+        """
+
+        groups = []
+        newest = {}    # message -> index of its newest group
+        placed = {}    # destination -> index of the group of its last row
+        for msg_id, dest, msg in rows:
+            i = newest.get(msg)
+            if i is None or i < placed.get(dest, -1):
+                i = len(groups)
+                groups.append((msg, []))
+                newest[msg] = i
+            groups[i][1].append((msg_id, dest))
+            placed[dest] = i
+
+        lines = []
+        for msg, entries in groups:
+            for i in range(0, len(entries), per_line):
+                chunk = entries[i:i + per_line]
+                lines.append(([d for _, d in chunk], msg, [m for m, _ in chunk]))
+        return lines
+
+
+    def tick(self):
+        """ Send as many queued lines as the budget allows right now.
+            Returns a Deferred firing with the number of messages sent.
+        """
+
+        budget = self.bucket.available()
+        if budget < 1:
+            return defer.succeed(0)
+
+        per_line = self.targets_per_line()
+        d = self.db.peek_msgs(budget * per_line, self.shard)
+        d.addCallback(self.send, budget, per_line)
+        d.addErrback(self.failed)
+        return d
+
+
+    def send(self, rows, budget, per_line):
+        """ Send packed rows, then delete them from the queue """
+
+        if not rows:
+            return 0
+
+        sent_ids = []
+        now = time.monotonic()
+        for targets, msg, ids in self.pack(rows, per_line)[:budget]:
+            if not self.bucket.consume():
+                break
+            before = self.lines_out()
+            self.client.msg(",".join(targets), msg)
+            # A long message is split into several lines; charge them all
+            lines = max(1, self.lines_out() - before)
+            self.bucket.tokens -= lines - 1
+            sent_ids.extend(ids)
+            self.lines_sent += lines
+            self.messages_sent += len(ids)
+            self.recent.append((now, lines, len(ids)))
+            logging.info("Broadcast to: " + ",".join(targets) + ":" + msg)
+
+        d = self.db.delete_msgs(sent_ids)
+        d.addCallback(lambda _: len(sent_ids))
+        return d
+
+
+    def lines_out(self):
+        """ Return the client's count of lines written to the connection """
+
+        return getattr(self.client, "lines_out", 0)
+
+
+    def failed(self, failure):
+        logging.error("Error: Dispatcher.tick(): " + failure.getErrorMessage())
+        return 0
+
+
+    def stats(self):
+        """ Return dict of budget settings and achieved send rate """
+
+        now = time.monotonic()
+        while self.recent and now - self.recent[0][0] > self.WINDOW:
+            self.recent.popleft()
+        window_lines = sum(n for _, n, _ in self.recent)
+        window_msgs = sum(n for _, _, n in self.recent)
+
+        return {
+            "rate": self.bucket.rate,
+            "burst": self.bucket.burst,
+            "tokens": round(self.bucket.tokens, 2),
+            "targets_per_line": self.targets_per_line(),
+            "lines_sent": self.lines_sent,
+            "messages_sent": self.messages_sent,
+            "lines_per_sec": round(window_lines / float(self.WINDOW), 3),
+            "messages_per_sec": round(window_msgs / float(self.WINDOW), 3),
+        }
@@ -0,0 +1,85 @@
+
+import time
+
+from dispatcher import TokenBucket
+
+
+class FloodControl:
+    """ Leaky-bucket command limits keyed by nick, hostmask and channel.
+
+        A command is allowed only if every bucket it touches holds 'cost'
+        tokens; otherwise nothing is spent and the rejection is counted.
+        Idle buckets that have refilled are dropped once more than
+        max_keys are held; if none are idle the oldest half is dropped.
+
+        Keyword arguments:
+        limits -- dict: {"nick"|"host"|"channel": (rate, burst)}; a kind
+                  that is missing or has rate <= 0 is not limited
+        max_keys -- int: bucket count that triggers pruning
+    """
+
+    def __init__(self, limits, max_keys=4096, clock=time.monotonic):
+        self.limits = dict((kind, (float(rate), float(burst)))
+                           for kind, (rate, burst) in limits.items() if float(rate) > 0)
+        self.max_keys = max(1, int(max_keys))
+        self.clock = clock
+        self.buckets = {}
+        self.allowed = 0
+        self.rejected = dict((kind, 0) for kind in self.limits)
+
+
+    def bucket(self, kind, key):
+        bucket = self.buckets.get((kind, key))
+        if bucket is None:
+            if len(self.buckets) >= self.max_keys:
+                self.prune()
+            if len(self.buckets) >= self.max_keys:
+                # Still full of active keys: forget the oldest half
+                for old in list(self.buckets)[:self.max_keys // 2 or 1]:
+                    del self.buckets[old]
+            rate, burst = self.limits[kind]
+            bucket = TokenBucket(rate, burst, self.clock)
+            self.buckets[(kind, key)] = bucket
+        return bucket
+
+
+    def allow(self, cost=1, **keys):
+        """ Return True and spend cost from every bucket if all can pay.
+
+            Keyword arguments:
+            cost -- float: tokens this command needs
+            keys -- string: nick=, host=, channel=; None skips that kind
+        """
+
+        buckets = []
+        for kind, key in keys.items():
+            if key is None or kind not in self.limits:
+                continue
+            bucket = self.bucket(kind, key)
+            bucket.refill()
+            if bucket.tokens < min(cost, bucket.burst):
+                self.rejected[kind] += 1
+                return False
+            buckets.append(bucket)
+
+        for bucket in buckets:
+            bucket.tokens -= min(cost, bucket.burst)
+        self.allowed += 1
+        return True
+
+
+    def prune(self):
+        """ Drop buckets that are full again, i.e. idle keys """
+
+        for key, bucket in list(self.buckets.items()):
+            bucket.refill()
+            if bucket.tokens >= bucket.burst:
+                del self.buckets[key]
+
+
+    def stats(self):
+        return {
+            "allowed": self.allowed,
+            "rejected": dict(self.rejected),
+            "keys": len(self.buckets),
+        }
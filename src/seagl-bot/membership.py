@@ -0,0 +1,165 @@
+
+import threading
+
+
+# Channel membership prefixes used when ISUPPORT PREFIX is not known
+DEFAULT_PREFIXES = "~&@%+"
+
+
+class Membership:
+    """ Per-channel member sets kept current from JOIN, PART, QUIT, KICK
+        and NICK events. NAMES replies replace a channel's set, and the
+        difference from the tracked set is counted as drift.
+
+        Channels whose membership changed are marked dirty until
+        take_dirty() collects them for persisting. NAMES replies for
+        channels we are not in (e.g. polled !shuffle group rooms) are kept
+        as one-off snapshots and persisted the same way.
+    """
+
+    def __init__(self):
+        self.channels = {}
+        self.polled = {}
+        self.pending = {}
+        self.dirty = set()
+        self.lock = threading.Lock()
+        self.events = 0
+        self.names_replies = 0
+        self.drift = 0
+
+
+    def reset(self, channel):
+        """ Start tracking channel with no members (we just joined it) """
+
+        with self.lock:
+            self.channels[channel.lower()] = set()
+            self.polled.pop(channel.lower(), None)
+
+
+    def drop(self, channel):
+        """ Stop tracking channel (we left or were kicked) """
+
+        with self.lock:
+            self.channels.pop(channel.lower(), None)
+            self.pending.pop(channel.lower(), None)
+            self.polled.pop(channel.lower(), None)
+            self.dirty.discard(channel.lower())
+
+
+    def joined(self, channel, nick):
+        with self.lock:
+            members = self.channels.get(channel.lower())
+            if members is not None and nick not in members:
+                members.add(nick)
+                self.dirty.add(channel.lower())
+            self.events += 1
+
+
+    def left(self, channel, nick):
+        with self.lock:
+            members = self.channels.get(channel.lower())
+            if members is not None and nick in members:
+                members.discard(nick)
+                self.dirty.add(channel.lower())
+            self.events += 1
+
+
+    def quit(self, nick):
+        """ Remove nick from every channel. Return list of those channels. """
+
+        rtn = []
+        with self.lock:
+            for channel, members in self.channels.items():
+                if nick in members:
+                    members.discard(nick)
+                    self.dirty.add(channel)
+                    rtn.append(channel)
+            self.events += 1
+        return rtn
+
+
+    def renamed(self, oldname, newname):
+        """ Rename nick in every channel. Return list of those channels. """
+
+        rtn = []
+        with self.lock:
+            for channel, members in self.channels.items():
+                if oldname in members:
+                    members.discard(oldname)
+                    members.add(newname)
+                    self.dirty.add(channel)
+                    rtn.append(channel)
+            self.events += 1
+        return rtn
+
+
+    def names(self, channel, nicks, prefixes=DEFAULT_PREFIXES):
+        """ Collect one RPL_NAMREPLY line. Nothing changes until names_end().
+
+            Keyword arguments:
+            channel -- string: channel name
+            nicks -- list: nicks, possibly with membership prefixes
+            prefixes -- string: prefix characters to strip
+        """
+
+        with self.lock:
+            pending = self.pending.setdefault(channel.lower(), set())
+            for nick in nicks:
+                nick = nick.lstrip(prefixes)
+                if nick:
+                    pending.add(nick)
+
+
+    def names_end(self, channel):
+        """ Apply the collected NAMES reply (RPL_ENDOFNAMES).
+            Return the number of nicks that differed from the tracked set.
+        """
+
+        channel = channel.lower()
+        with self.lock:
+            names = self.pending.pop(channel, set())
+            members = self.channels.get(channel)
+            self.names_replies += 1
+            if members is None:
+                # NAMES for a channel we are not in: nothing to reconcile,
+                # but its count is still stored
+                self.polled[channel] = names
+                self.dirty.add(channel)
+                return 0
+            drift = len(members ^ names) if members else 0
+            self.drift += drift
+            if members != names:
+                self.channels[channel] = names
+                self.dirty.add(channel)
+            elif not members:
+                self.dirty.add(channel)
+            return drift
+
+
+    def count(self, channel):
+        with self.lock:
+            return len(self.channels.get(channel.lower(), ()))
+
+
+    def take_dirty(self):
+        """ Return {channel: sorted nick list} for changed channels, and
+            clear the dirty set.
+        """
+
+        with self.lock:
+            rtn = dict((c, sorted(self.channels[c])) for c in self.dirty if c in self.channels)
+            for c in self.dirty.intersection(self.polled):
+                rtn[c] = sorted(self.polled.pop(c))
+            self.dirty = set()
+        return rtn
+
+
+    def stats(self):
+        with self.lock:
+            return {
+                "channels": len(self.channels),
+                "members": sum(len(m) for m in self.channels.values()),
+                "events": self.events,
+                "names_replies": self.names_replies,
+                "drift": self.drift,
+            }
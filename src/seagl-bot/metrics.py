@@ -0,0 +1,137 @@
+
+import os
+import json
+import time
+import bisect
+import logging
+
+
+# Upper bounds (ms) of the latency histogram buckets; the last bucket is +Inf
+BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+def atomic_write(path, data):
+    """ Write data to path so readers see either the old or the new file,
+        never a partial one.
+
+        Keyword arguments:
+        path -- string: destination file
+        data -- string: file contents
+    """
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as fp:
+        fp.write(data)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(tmp_path, path)
+
+
+class MetricsPublisher:
+    """ Publish a dict as a json file, skipping unchanged snapshots.
+
+        If ndjson_path is set, every published change is also appended to
+        it as one json line: {"ts": <epoch>, "set": {...}, "removed": [...]}
+        holding only the keys that changed since the previous snapshot.
+
+        Keyword arguments:
+        path -- string: json file replaced on every change
+        ndjson_path -- string: optional append-only time-series file
+    """
+
+    def __init__(self, path, ndjson_path=""):
+        self.path = path
+        self.ndjson_path = ndjson_path
+        self.last = None
+        self.last_blob = None
+        self.published = 0
+        self.skipped = 0
+
+
+    def delta(self, metric_dict):
+        """ Return (changed, removed) relative to the last snapshot """
+
+        last = self.last or {}
+        changed = dict((k, v) for k, v in metric_dict.items() if last.get(k) != v)
+        removed = sorted(k for k in last if k not in metric_dict)
+        return changed, removed
+
+
+    def publish(self, metric_dict):
+        """ Write metric_dict if it changed. Return True if the file is
+            current (written, or unchanged), False if the write failed.
+        """
+
+        blob = json.dumps(metric_dict, sort_keys=True)
+        if blob == self.last_blob:
+            self.skipped += 1
+            return True
+
+        try:
+            atomic_write(self.path, blob)
+            if self.ndjson_path:
+                changed, removed = self.delta(metric_dict)
+                line = json.dumps({"ts": round(time.time(), 3), "set": changed, "removed": removed},
+                                  sort_keys=True)
+                with open(self.ndjson_path, "a") as fp:
+                    fp.write(line + "\n")
+        except Exception as e:
+            logging.error("Error: MetricsPublisher.publish(): " + self.path + ": " + str(e))
+            return False
+
+        self.last = metric_dict
+        self.last_blob = blob
+        self.published += 1
+        return True
+
+
+class LatencyHistogram:
+    """ Fixed bucket latency histogram """
+
+    def __init__(self, bounds=BUCKETS_MS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+
+    def observe(self, ms):
+        self.counts[bisect.bisect_left(self.bounds, ms)] += 1
+        self.count += 1
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+
+
+    def percentile(self, p):
+        """ Return the bucket upper bound holding the p-th percentile.
+            Values past the last bound report the observed max.
+
+            Keyword arguments:
+            p -- float: 0-100
+        """
+
+        if not self.count:
+            return 0.0
+        rank = self.count * p / 100.0
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                if i < len(self.bounds):
+                    return float(min(self.bounds[i], self.max))
+                break
+        return self.max
+
+
+    def to_dict(self):
+        buckets = dict((str(b), n) for b, n in zip(self.bounds, self.counts))
+        buckets["+Inf"] = self.counts[-1]
+        return {
+            "mean_ms": round(self.total / self.count, 3) if self.count else 0.0,
+            "max_ms": round(self.max, 3),
+            "p50_ms": round(self.percentile(50), 3),
+            "p99_ms": round(self.percentile(99), 3),
+            "buckets": buckets,
+        }
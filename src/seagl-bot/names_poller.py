@@ -0,0 +1,94 @@
+
+import math
+import logging
+
+from twisted.internet import reactor
+
+
+class NamesPoller:
+    """ Walk the managed channels round-robin, sending NAMES so that every
+        channel is refreshed within 'freshness' seconds.
+
+        The poll interval is recomputed every tick from the channel count
+        and clamped to [min_interval, max_interval].
+
+        Keyword arguments:
+        client -- IRCClient: connection used to send NAMES
+        channels -- callable: returns the current list of managed channels
+        freshness -- float: target seconds between refreshes of one channel
+        batch -- int: channels queried per tick
+        min_interval -- float: shortest allowed tick interval
+        max_interval -- float: longest allowed tick interval
+    """
+
+    def __init__(self, client, channels, freshness=60, batch=4,
+                 min_interval=1, max_interval=5, clock=reactor):
+        self.client = client
+        self.channels = channels
+        self.freshness = float(freshness)
+        self.batch = max(1, int(batch))
+        self.min_interval = float(min_interval)
+        self.max_interval = max(self.min_interval, float(max_interval))
+        self.clock = clock
+        self.position = 0
+        self.call = None
+        self.lines_sent = 0
+
+
+    def start(self):
+        self.stop()
+        self.call = self.clock.callLater(0, self.tick)
+
+
+    def stop(self):
+        if self.call is not None and self.call.active():
+            self.call.cancel()
+        self.call = None
+
+
+    def interval(self, num_channels):
+        """ Return seconds until the next tick for num_channels channels """
+
+        if num_channels < 1:
+            return self.max_interval
+        ticks = math.ceil(num_channels / float(self.batch))
+        wanted = self.freshness / ticks
+        return min(self.max_interval, max(self.min_interval, wanted))
+
+
+    def targets_per_line(self):
+        """ Return how many channels the server accepts per NAMES line """
+
+        supported = getattr(self.client, "supported", None)
+        if supported is None:
+            return 1
+        targmax = supported.getFeature("TARGMAX") or {}
+        if "NAMES" in targmax:
+            return targmax["NAMES"] or self.batch
+        return 1
+
+
+    def next_batch(self, channels):
+        """ Return the next channels in round-robin order """
+
+        if not channels:
+            return []
+        if self.position >= len(channels):
+            self.position = 0
+        batch = channels[self.position:self.position + self.batch]
+        self.position += len(batch)
+        return batch
+
+
+    def tick(self):
+        channels = []
+        try:
+            channels = self.channels()
+            batch = self.next_batch(channels)
+            per_line = max(1, self.targets_per_line())
+            for i in range(0, len(batch), per_line):
+                self.client.sendLine("NAMES %s" % ",".join(batch[i:i + per_line]))
+                self.lines_sent += 1
+        except Exception as e:
+            logging.error("Error: NamesPoller.tick(): " + str(e))
+        self.call = self.clock.callLater(self.interval(len(channels)), self.tick)
@@ -9,6 +9,18 @@ check in private information like server names or passwords.)
 # The bot's IRC nick
 nickname = ""
 
+# Number of IRC connections. Channels are spread over them by consistent
+# hashing (shard_replicas ring points per connection); new rooms go to the
+# connection with the fewest channels, and each connection has its own
+# dispatch_rate budget. Initial and admin channels stay on the first
+# connection. Nicks default to nickname, nickname1, nickname2, ...
+# unless listed in bot_nicks.
+bot_connections='1'
+bot_nicks=[]
+shard_replicas='64'
+# Alert the admin channels when any connection is in more channels than this
+shard_channel_limit='105'
+
 # Hostname of the IRC server.  For now, only one.
 serverhost = "irc.freenode.net"
 
@@ -25,6 +37,31 @@ admins = []
 # SQLite 3 database path.
 sqlite_path = "/path/to/seagl-bot.db"
 metric_path = "/path/to/channel_counts.json"
+# Optional append-only NDJSON file of channel count changes. '' disables.
+metric_ndjson_path = ""
+# Directory for bot.log and channel logs. '' means /home/<user>/seagl-bot.d
+bot_log_dir = ""
+# Optional json file for the bot's own metrics (send rate etc). '' disables.
+bot_metrics_path = ""
+
+# Number of pooled read-only SQLite connections shared by the bot.
+sqlite_readers='4'
+# SQLite connection profile. journal_mode: delete|truncate|persist|memory|wal|off,
+# synchronous: off|normal|full|extra, cache_size in pages (negative: KiB),
+# mmap_size in bytes, busy_timeout in ms, cached_statements per connection.
+sqlite_journal_mode='wal'
+sqlite_synchronous='normal'
+sqlite_cache_size='-16000'
+sqlite_mmap_size='67108864'
+sqlite_busy_timeout='5000'
+sqlite_cached_statements='256'
+# In WAL mode the log is checkpointed every checkpoint_interval seconds
+# (mode: passive|full|restart|truncate) and truncated on shutdown.
+sqlite_checkpoint_interval='300'
+sqlite_checkpoint_mode='passive'
+# Time every Database method (calls, latency, rows). Exported under
+# "database" in bot_metrics_path and shown by !dbstats. Off costs nothing.
+db_timing='False'
 
 # Bot privileged users
 botops = ""
@@ -33,9 +70,60 @@ botops = ""
 JITSI_PREFIX = "https://meet.seagl.org/seagl-"
 
 # Time intervals
-names_query_interval='5'
-broadcaster_interval='20'
+# Channel membership is tracked from JOIN/PART/QUIT/KICK/NICK and written
+# every membership_flush_interval seconds. NAMES is sent on join by the
+# server and polled only to reconcile drift: every channel is re-checked
+# within names_freshness seconds, names_batch channels per tick, one tick
+# every names_min_interval to names_query_interval seconds.
+membership_flush_interval='2'
+names_query_interval='60'
+names_freshness='1800'
+names_batch='4'
+names_min_interval='1'
 metrics_interval='120'
 channel_limit_audit='600'
 channel_user_audit='630'
+# Inactivity audit (every channel_user_audit seconds): a channel whose user
+# count drops below channel_audit_low stays "low" until it reaches
+# channel_audit_high, and is left after channel_audit_window audits in a
+# row in the low state.
+channel_audit_window='3'
+channel_audit_low='3'
+channel_audit_high='5'
+attendee_flush_interval='5'
+
+# Outbound message queue budget: lines per second, burst size, how often
+# the queue is checked (seconds), and max targets packed into one PRIVMSG.
+dispatch_rate='1'
+dispatch_burst='4'
+dispatch_tick='0.5'
+dispatch_max_targets='4'
+# !LA reads topic subscribers and queues them this many per transaction.
+announce_chunk_size='500'
+
+# Channel logs: max open log files, buffered bytes that force a flush,
+# and flush interval (seconds).
+log_max_open='32'
+log_flush_bytes='65536'
+log_flush_interval='5'
+
+# channel_counts history: rows older than the retention are deleted (0 keeps
+# everything), rows older than downsample_after are thinned to one per
+# channel per downsample_minutes. Pruning runs every prune_interval seconds.
+channel_counts_retention_hours='72'
+channel_counts_downsample_after_hours='6'
+channel_counts_downsample_minutes='15'
+channel_counts_prune_interval='3600'
 
+# Command flood control: leaky buckets per nick, per hostmask and per
+# channel (rate = commands per second, burst = commands saved up; rate 0
+# disables that bucket). Bot operators are exempt. Commands cost 1 token
+# unless overridden here, e.g. {"createroom": "5", "ask": "2"}.
+flood_nick_rate='0.2'
+flood_nick_burst='5'
+flood_host_rate='0.5'
+flood_host_burst='10'
+flood_channel_rate='1'
+flood_channel_burst='10'
+flood_max_keys='4096'
+flood_costs = {}
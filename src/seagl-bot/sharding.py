@@ -0,0 +1,39 @@
+
+import bisect
+import hashlib
+
+
+def hash_key(key):
+    """ Return a stable 64 bit hash of a string """
+
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing:
+    """ Consistent hash ring mapping keys (channels, nicks) to shards.
+
+        Each shard is placed on the ring 'replicas' times, so adding a
+        shard only moves about 1/N of the keys.
+
+        Keyword arguments:
+        shards -- list: shard numbers
+        replicas -- int: ring points per shard
+    """
+
+    def __init__(self, shards, replicas=64):
+        points = []
+        for shard in shards:
+            for r in range(max(1, int(replicas))):
+                points.append((hash_key("shard-%d-%d" % (shard, r)), shard))
+        points.sort()
+        self.hashes = [h for h, _ in points]
+        self.shards = [s for _, s in points]
+
+
+    def node(self, key):
+        """ Return the shard owning key (case-insensitive) """
+
+        if not self.hashes:
+            return 0
+        i = bisect.bisect(self.hashes, hash_key(key.lower()))
+        return self.shards[i % len(self.shards)]
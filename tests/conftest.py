@@ -0,0 +1,31 @@
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "seagl-bot"))
+
+import bench
+
+# The bot modules read a 'config' module at import time; use the bench one
+config = bench.load_config(tempfile.mkdtemp(prefix="seagl-bot-test-"))
+
+import database
+
+
+@pytest.fixture
+def cfg():
+    """ The shared config module; change it with monkeypatch.setattr() """
+
+    return config
+
+
+@pytest.fixture
+def db(tmp_path):
+    """ A fresh Database seeded with the initial and admin channels """
+
+    d = database.Database(str(tmp_path / "db" / "seagl-bot.db"))
+    yield d
+    d.close()
@@ -0,0 +1,50 @@
+
+import pytest
+
+
+def audit(db, monkeypatch, counts):
+    monkeypatch.setattr(db, "get_channel_counts", lambda: dict(counts))
+    return db.audit_channels()
+
+
+@pytest.fixture
+def window(cfg, monkeypatch):
+    monkeypatch.setattr(cfg, "channel_audit_window", "3")
+    monkeypatch.setattr(cfg, "channel_audit_low", "3")
+    monkeypatch.setattr(cfg, "channel_audit_high", "5")
+
+
+def test_one_low_sample_does_not_flag(db, monkeypatch, window):
+    db.add_room("op", "room-a", "#seagl-a")
+    flagged = [audit(db, monkeypatch, {"#seagl-a": c}) for c in (4, 4, 2)]
+    assert flagged == [[], [], []]
+
+
+def test_flagged_after_window_in_low_state(db, monkeypatch, window):
+    db.add_room("op", "room-a", "#seagl-a")
+    flagged = [audit(db, monkeypatch, {"#seagl-a": c}) for c in (2, 4, 4)]
+    assert flagged == [[], [], ["#seagl-a"]]
+
+
+def test_reaching_high_water_resets(db, monkeypatch, window):
+    db.add_room("op", "room-a", "#seagl-a")
+    flagged = [audit(db, monkeypatch, {"#seagl-a": c}) for c in (2, 2, 5, 2, 2)]
+    assert flagged == [[], [], [], [], []]
+    assert "#seagl-a" in db.low_channels
+
+
+def test_low_state_is_persisted(db, monkeypatch, window):
+    db.add_room("op", "room-a", "#seagl-a")
+    audit(db, monkeypatch, {"#seagl-a": 1})
+    db.low_channels = {}
+    db.load_channel_audit()
+    assert "#seagl-a" in db.low_channels
+
+
+@pytest.mark.parametrize("admin", ["seagl-staff", "#seagl-staff", "Seagl-Staff"])
+def test_initial_and_admin_channels_never_flagged(db, cfg, monkeypatch, window, admin):
+    # !AA used to rewrite config.channels_admin with a '#' prefix
+    monkeypatch.setattr(cfg, "channels_admin", [admin])
+    counts = {"#seagl-staff": 0, "#seagl-hallway": 0}
+    flagged = [audit(db, monkeypatch, counts) for _ in range(5)]
+    assert flagged == [[]] * 5
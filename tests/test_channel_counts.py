@@ -0,0 +1,35 @@
+
+import database
+
+
+def fail_inserts_for(db, channel):
+    db.connection.execute("""CREATE TEMP TRIGGER fail_insert BEFORE INSERT ON channel_counts
+                             WHEN NEW.channel = '%s' BEGIN SELECT RAISE(ABORT, 'forced'); END""" % channel)
+
+
+def test_unchanged_membership_is_not_rewritten(db):
+    assert db.add_channel_counts({"#seagl-a": ["alice", "bob"]}) == 1
+    assert db.add_channel_counts({"#seagl-a": ["bob", "alice"]}) == 0
+    assert db.add_channel_counts({"#seagl-a": ["bob"]}) == 1
+
+
+def test_failed_write_does_not_cache_nick_ids(db):
+    db.add_rooms("op", [("room-a", "#seagl-a"), ("room-b", "#seagl-b")])
+    fail_inserts_for(db, "#seagl-boom")
+
+    assert db.add_channel_counts({"#seagl-boom": ["alice"]}) == -1
+    assert "alice" not in db.nick_ids
+
+    assert db.add_channel_counts({"#seagl-a": ["bob"], "#seagl-b": ["alice", "bob"]}) == 2
+    assert len(set(db.nick_ids.values())) == 2
+    assert sorted(db.nick_ids) == ["alice", "bob"]
+
+    # Stored members decode to the same nicks when loaded again
+    reopened = database.Database(db.pool.sqlite_path)
+    try:
+        latest = reopened.get_channel_count_metric()
+        assert latest["#seagl-a"] == [1, "bob"]
+        assert latest["#seagl-b"][0] == 2
+        assert sorted(latest["#seagl-b"][1].split(",")) == ["alice", "bob"]
+    finally:
+        reopened.close()
@@ -0,0 +1,74 @@
+
+from twisted.internet import defer
+
+import dispatcher
+
+
+class FakeClient:
+    def __init__(self, split=1):
+        self.split = split
+        self.lines_out = 0
+        self.sent = []
+
+    def msg(self, target, message):
+        self.sent.append((target, message))
+        self.lines_out += self.split
+
+
+class FakeDB:
+    def __init__(self, rows):
+        self.rows = rows
+        self.deleted = []
+
+    def peek_msgs(self, limit, shard=None):
+        return defer.succeed(self.rows[:limit])
+
+    def delete_msgs(self, ids):
+        self.deleted.extend(ids)
+        return defer.succeed(True)
+
+
+def order_per_dest(lines):
+    rtn = {}
+    for targets, msg, ids in lines:
+        for dest in targets:
+            rtn.setdefault(dest, []).append(msg)
+    return rtn
+
+
+def test_pack_keeps_per_destination_order():
+    rows = [(1, "#a", "m1"), (2, "#b", "m2"), (3, "#a", "m2"), (4, "#b", "m1"), (5, "#c", "m1")]
+    lines = dispatcher.Dispatcher(None, None).pack(rows, 4)
+
+    assert order_per_dest(lines) == {"#a": ["m1", "m2"], "#b": ["m2", "m1"], "#c": ["m1"]}
+    assert lines == [(["#a"], "m1", [1]), (["#b", "#a"], "m2", [2, 3]), (["#b", "#c"], "m1", [4, 5])]
+
+
+def test_pack_merges_and_splits_by_targets_per_line():
+    rows = [(i, "#c%d" % i, "hello") for i in range(5)]
+    lines = dispatcher.Dispatcher(None, None).pack(rows, 2)
+    assert [targets for targets, _, _ in lines] == [["#c0", "#c1"], ["#c2", "#c3"], ["#c4"]]
+
+
+def test_tick_spends_budget_and_deletes_sent_rows():
+    db = FakeDB([(i, "#c%d" % i, "m%d" % i) for i in range(10)])
+    client = FakeClient()
+    d = dispatcher.Dispatcher(client, db, rate=0.001, burst=3)
+
+    sent = []
+    d.tick().addCallback(sent.append)
+    assert sent == [3]
+    assert db.deleted == [0, 1, 2]
+    assert d.stats()["lines_sent"] == 3
+
+
+def test_split_messages_are_charged_per_line():
+    db = FakeDB([(i, "#c%d" % i, "long") for i in range(4)])
+    client = FakeClient(split=3)
+    d = dispatcher.Dispatcher(client, db, rate=0.001, burst=4)
+
+    d.tick()
+    # The first message uses 3 of the 4 tokens, the second overdraws
+    assert len(client.sent) == 2
+    assert d.lines_sent == 6
+    assert d.bucket.tokens < 0
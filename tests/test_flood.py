@@ -0,0 +1,63 @@
+
+import flood
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def make(clock, max_keys=4096):
+    return flood.FloodControl({"nick": (1, 3), "channel": (10, 5), "host": (0, 1)},
+                              max_keys=max_keys, clock=clock)
+
+
+def test_burst_then_refill():
+    clock = Clock()
+    fc = make(clock)
+    assert [fc.allow(nick="a") for _ in range(4)] == [True, True, True, False]
+    clock.now += 1
+    assert fc.allow(nick="a")
+    assert not fc.allow(nick="a")
+    assert fc.stats()["rejected"]["nick"] == 2
+
+
+def test_keys_are_independent():
+    clock = Clock()
+    fc = make(clock)
+    for _ in range(3):
+        fc.allow(nick="a")
+    assert not fc.allow(nick="a")
+    assert fc.allow(nick="b")
+
+
+def test_rejection_spends_nothing():
+    clock = Clock()
+    fc = make(clock)
+    # The channel bucket has room, the nick bucket does not
+    for _ in range(3):
+        fc.allow(nick="a", channel="#c")
+    assert not fc.allow(nick="a", channel="#c")
+    assert fc.bucket("channel", "#c").tokens == 2
+
+
+def test_cost_and_unlimited_kinds():
+    clock = Clock()
+    fc = make(clock)
+    assert fc.allow(cost=3, nick="a", host="example.org", channel=None)
+    assert not fc.allow(nick="a")
+    # rate 0 disables the host limit entirely
+    assert "host" not in fc.limits
+
+
+def test_idle_keys_are_pruned():
+    clock = Clock()
+    fc = make(clock, max_keys=4)
+    for nick in "abcd":
+        fc.allow(nick=nick)
+    clock.now += 10
+    fc.allow(nick="e")
+    assert sorted(k for _, k in fc.buckets) == ["e"]
@@ -0,0 +1,58 @@
+
+import membership
+
+
+def joined(m, channel, nicks):
+    m.reset(channel)
+    for nick in nicks:
+        m.joined(channel, nick)
+
+
+def test_join_part_quit_and_rename():
+    m = membership.Membership()
+    joined(m, "#Seagl-A", ["alice", "bob"])
+    joined(m, "#seagl-b", ["bob"])
+
+    m.left("#seagl-a", "alice")
+    assert m.renamed("bob", "robert") == ["#seagl-a", "#seagl-b"]
+    assert m.take_dirty() == {"#seagl-a": ["robert"], "#seagl-b": ["robert"]}
+
+    assert m.quit("robert") == ["#seagl-a", "#seagl-b"]
+    assert m.count("#seagl-a") == 0
+    assert m.take_dirty() == {"#seagl-a": [], "#seagl-b": []}
+    assert m.take_dirty() == {}
+
+
+def test_names_reconciles_drift():
+    m = membership.Membership()
+    joined(m, "#seagl-a", ["alice", "bob"])
+    m.take_dirty()
+
+    m.names("#seagl-a", ["@alice", "+carol"])
+    m.names("#seagl-a", ["dave"])
+    assert m.names_end("#seagl-a") == 3
+    assert m.take_dirty() == {"#seagl-a": ["alice", "carol", "dave"]}
+
+    # A matching reply changes nothing
+    m.names("#seagl-a", ["alice", "carol", "dave"])
+    assert m.names_end("#seagl-a") == 0
+    assert m.take_dirty() == {}
+
+
+def test_names_for_channel_not_joined_is_a_snapshot():
+    m = membership.Membership()
+    m.names("#seagl-topic_1", ["alice", "%bob"])
+    assert m.names_end("#seagl-topic_1") == 0
+    m.names_end("#seagl-topic_2")
+
+    assert m.take_dirty() == {"#seagl-topic_1": ["alice", "bob"], "#seagl-topic_2": []}
+    assert m.take_dirty() == {}
+    assert m.stats()["channels"] == 0
+
+
+def test_drop_forgets_channel():
+    m = membership.Membership()
+    joined(m, "#seagl-a", ["alice"])
+    m.drop("#seagl-a")
+    m.joined("#seagl-a", "bob")
+    assert m.take_dirty() == {}
@@ -0,0 +1,45 @@
+
+import sqlite3
+
+import pytest
+
+import database
+
+
+@pytest.fixture
+def pool(tmp_path, monkeypatch):
+    monkeypatch.setattr(database.ConnectionPool, "READER_WAIT", 0.05)
+    p = database.ConnectionPool(str(tmp_path / "pool.db"), max_readers=1)
+    yield p
+    p.close()
+
+
+def test_readers_are_reused(pool):
+    with pool.reader() as first:
+        pass
+    with pool.reader() as second:
+        assert second is first
+    assert pool.num_readers == 1
+
+
+def test_failed_connect_gives_the_slot_back(pool, monkeypatch):
+    def fail():
+        raise sqlite3.OperationalError("unable to open database file")
+
+    monkeypatch.setattr(pool, "connect", fail)
+    for _ in range(3):
+        with pytest.raises(sqlite3.OperationalError):
+            with pool.reader():
+                pass
+    assert pool.num_readers == 0
+
+    monkeypatch.undo()
+    with pool.reader() as connection:
+        assert connection.execute("SELECT 1").fetchone()[0] == 1
+
+
+def test_waiting_for_a_reader_times_out(pool):
+    with pool.reader():
+        with pytest.raises(sqlite3.OperationalError):
+            with pool.reader():
+                pass
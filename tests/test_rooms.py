@@ -0,0 +1,42 @@
+
+import database
+
+
+def test_add_rooms_skips_existing_channels_and_rooms(db):
+    assert db.add_rooms("op", [("room-a", "#seagl-a"), ("room-b", "#Seagl-B")]) == 2
+    # Existing channel, existing room, duplicate within the batch, new
+    added = db.add_rooms("op", [("room-x", "#seagl-a"), ("room-a", "#seagl-x"),
+                                ("room-c", "#seagl-c"), ("room-c2", "#seagl-c"),
+                                ("room-d", "#seagl-d")])
+    assert added == 2
+    rooms = db.room_list()
+    assert rooms[-4:] == ["#seagl-a", "#seagl-b", "#seagl-c", "#seagl-d"]
+    assert db.room_channels["#seagl-d"] == db.connection.execute(
+        "SELECT id FROM rooms WHERE irc_channel='#seagl-d'").fetchone()[0]
+
+
+def test_shuffle_persists_assignments(db, cfg):
+    # Only bot operators may create a topic
+    db.join_topic(cfg.botops[0], "trivia")
+    for i in range(22):
+        db.join_topic("nick%d" % i, "trivia")
+
+    topic, groups = db.shuffle_users("trivia 5")
+    assert len(groups) == 4
+    assert sorted(n for g in groups.values() for n in g) == sorted(
+        ["nick%d" % i for i in range(22)] + [cfg.botops[0]])
+    assert "#seagl-trivia_3" in db.room_list()
+    assert "Channel:#seagl-trivia_" in db.get_assignment("nick7", "trivia")
+
+    # Shuffling again replaces the rows, and the unique index is back
+    db.shuffle_users("trivia 10")
+    rows = db.connection.execute("SELECT COUNT(*) FROM assignments WHERE topic='trivia'").fetchone()[0]
+    assert rows == 23
+    indexes = [r[1] for r in db.connection.execute("PRAGMA index_list(assignments)")]
+    assert "assignments_topic_nick" in indexes
+
+    reopened = database.Database(db.pool.sqlite_path)
+    try:
+        assert reopened.assignments["trivia"] == db.assignments["trivia"]
+    finally:
+        reopened.close()